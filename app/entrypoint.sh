@@ -8,4 +8,7 @@ done
 
 alembic upgrade head
 
-gunicorn main:app --workers 6 --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+gunicorn main:app --config gunicorn.conf.py --workers 6 --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000
@@ -39,7 +39,10 @@ current_path = os.path.dirname(os.path.abspath(__file__))
 ROOT_PATH = os.path.join(current_path, '..')
 sys.path.append(ROOT_PATH)
 
-from db.database import engine_sync, Base
+from sqlalchemy import create_engine
+
+from core.config import SETTINGS
+from db.database import Base
 from models.models import *
 target_metadata = Base.metadata
 
@@ -87,7 +90,7 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
-    connectable = engine_sync
+    connectable = create_engine(SETTINGS.SQLALCHEMY_DATABASE_URL_SYNC)
 
     with connectable.connect() as connection:
         context.configure(
@@ -0,0 +1,46 @@
+"""key refresh sessions by user agent fingerprint instead of the raw user agent
+
+Revision ID: 3b7e9c2d5a16
+Revises: 8f2d4b6a1c93
+Create Date: 2023-08-28 10:12:39.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3b7e9c2d5a16'
+down_revision = '8f2d4b6a1c93'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 10000
+
+# same value as services.useragent.ua_fingerprint
+BACKFILL_BATCH = sa.text("""
+UPDATE content.refresh_tokens SET ua_fingerprint = substring(sha256(convert_to(useragent, 'UTF8')) FROM 1 FOR 16)
+WHERE id IN (SELECT id FROM content.refresh_tokens WHERE ua_fingerprint IS NULL LIMIT :batch_size)
+RETURNING id, ua_fingerprint
+""")
+
+
+def upgrade() -> None:
+    op.add_column('refresh_tokens', sa.Column('ua_fingerprint', sa.LargeBinary(length=16), nullable=True),
+                  schema='content')
+    # every batch commits on its own, so rows are locked only while their batch runs
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        while rows := connection.execute(BACKFILL_BATCH, {'batch_size': BACKFILL_BATCH_SIZE}).all():
+            if missing := [str(row_id) for row_id, fingerprint in rows if fingerprint is None]:
+                # earlier batches are committed: delete the sessions, drop the ua_fingerprint column, then rerun
+                raise RuntimeError(f'{len(missing)} refresh tokens got no fingerprint, e.g. session {missing[0]}')
+    op.alter_column('refresh_tokens', 'ua_fingerprint', nullable=False, schema='content')
+    op.create_unique_constraint('ua_fingerprint_user_uniq_constr', 'refresh_tokens', ['user_id', 'ua_fingerprint'],
+                                schema='content')
+    op.drop_constraint('ua_user_uniq_constr', 'refresh_tokens', schema='content')
+
+
+def downgrade() -> None:
+    op.create_unique_constraint('ua_user_uniq_constr', 'refresh_tokens', ['useragent', 'user_id'], schema='content')
+    op.drop_constraint('ua_fingerprint_user_uniq_constr', 'refresh_tokens', schema='content')
+    op.drop_column('refresh_tokens', 'ua_fingerprint', schema='content')
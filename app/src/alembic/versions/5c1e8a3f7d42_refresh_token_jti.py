@@ -0,0 +1,56 @@
+"""store refresh token jti instead of encoded token
+
+Revision ID: 5c1e8a3f7d42
+Revises: 09ed740dd95b
+Create Date: 2023-08-14 19:02:11.418305
+
+"""
+import sqlalchemy_utils
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5c1e8a3f7d42'
+down_revision = '09ed740dd95b'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 10000
+
+# jti claim of the payload segment of stored JWT, payload is base64url without padding
+BACKFILL_BATCH = sa.text("""
+UPDATE content.refresh_tokens SET jti = (
+    convert_from(decode(rpad(
+        translate(split_part(refresh_token, '.', 2), '-_', '+/'),
+        ((length(split_part(refresh_token, '.', 2)) + 3) / 4) * 4, '='
+    ), 'base64'), 'UTF8')::json ->> 'jti'
+)::uuid
+WHERE id IN (SELECT id FROM content.refresh_tokens WHERE jti IS NULL LIMIT :batch_size)
+RETURNING id, jti
+""")
+
+
+def upgrade() -> None:
+    op.add_column('refresh_tokens',
+                  sa.Column('jti', sqlalchemy_utils.types.uuid.UUIDType(binary=False), nullable=True),
+                  schema='content')
+    # every batch commits on its own, so rows are locked only while their batch runs
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        while rows := connection.execute(BACKFILL_BATCH, {'batch_size': BACKFILL_BATCH_SIZE}).all():
+            if missing := [str(row_id) for row_id, jti in rows if jti is None]:
+                # earlier batches are committed: delete the sessions, drop the jti column, then rerun
+                raise RuntimeError(f'{len(missing)} refresh tokens have no jti claim, e.g. session {missing[0]}')
+    op.alter_column('refresh_tokens', 'jti', nullable=False, schema='content')
+    op.create_unique_constraint('refresh_tokens_jti_key', 'refresh_tokens', ['jti'], schema='content')
+    op.drop_column('refresh_tokens', 'refresh_token', schema='content')
+
+
+def downgrade() -> None:
+    # encoded tokens can not be restored from jti, sessions are dropped and users log in again
+    op.execute('DELETE FROM content.refresh_tokens')
+    op.add_column('refresh_tokens', sa.Column('refresh_token', sa.String(), nullable=False), schema='content')
+    op.create_unique_constraint('refresh_tokens_refresh_token_key', 'refresh_tokens', ['refresh_token'],
+                                schema='content')
+    op.drop_constraint('refresh_tokens_jti_key', 'refresh_tokens', schema='content')
+    op.drop_column('refresh_tokens', 'jti', schema='content')
@@ -0,0 +1,29 @@
+"""index refresh sessions by the time their token was issued
+
+Revision ID: 8f2d4b6a1c93
+Revises: 5c1e8a3f7d42
+Create Date: 2023-08-21 11:47:05.206518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8f2d4b6a1c93'
+down_revision = '5c1e8a3f7d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # built without blocking writes to the table
+    with op.get_context().autocommit_block():
+        op.create_index('ix_content_refresh_tokens_issued_at', 'refresh_tokens',
+                        [sa.text('coalesce(updated_at, created_at)')], schema='content',
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_content_refresh_tokens_issued_at', table_name='refresh_tokens', schema='content',
+                      postgresql_concurrently=True)
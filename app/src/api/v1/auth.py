@@ -1,49 +1,91 @@
+import hmac
+import logging
 from http import HTTPStatus
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, Form, Body, Header
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Form, Body, Header, Query
+from fastapi.responses import ORJSONResponse
 from redis.asyncio.client import Redis
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from models.models import HTTPErrorDetails
-from models.schemas.auth import UserCreate, User
-from db.database import get_db
+from models.schemas.auth import UserCreate, User, Availability, Introspection
+from db.database import get_db, release_connection, async_session
 from db.redis_inj import get_redis
-from services.crud.users import create_user, get_user_by_email, get_user_by_username
-from services.crud.refresh_tokens import create_token, get_tokens_by_user_id, get_token_by_token, \
-    update_token_by_ua_uid, \
-    delete_token, get_token_by_ua_uid
-from services.password import get_hashed_password, verify_password
-from services.jwt import create_access_token, create_refresh_token, JWTBearer, blacklisting, check_blacklist
+from core.config import SETTINGS
+from services.availability import taken_names
+from services.crud.users import create_user, get_user_by_email, get_user_by_username, get_user_by_email_or_username, \
+    get_cached_user_by_email, update_password_hash
+from services.crud.refresh_tokens import upsert_token, delete_token_by_ua_uid, delete_tokens_by_user_id
+from services.rate_limit import login_rate_limit
+from services.session_store import TokenReuseDetected, SessionsNotRecovered
+from services.password import get_hashed_password_async, verify_password_async, password_needs_update
+from services.jwt import create_access_token, create_refresh_token, JWTBearer, VerifiedToken, blacklisting, \
+    blacklisting_many, check_blacklist, verify_token, revoke_all_tokens, refresh_token_id, introspect
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
-@router.post('/signup', response_model=User)
-async def signup_user(data: UserCreate, db: AsyncSession = Depends(get_db)):
-    if await get_user_by_email(db=db, email=data.email) or await get_user_by_username(db=db, username=data.username):
-        raise HTTPException(status_code=HTTPStatus.CONFLICT, detail=HTTPErrorDetails.CONFLICT.value)
+async def _rehash_password(user_id: str, password: str, old_hash: str):
+    """Replace hash made with an outdated scheme or cost, runs after the login response is sent"""
+    try:
+        new_hash = await get_hashed_password_async(password)
+    except HTTPException:
+        return  # hashing pool is busy, next login of the user tries again
+    async with async_session() as db:
+        if not await update_password_hash(db=db, user_id=user_id, old_hash=old_hash, new_hash=new_hash):
+            logger.info('Password of user %s changed before rehash, skipped', user_id)
 
-    data.password_hash = get_hashed_password(data.password_hash)
-    return await create_user(db=db, user=data)
 
+@router.post('/signup', response_model=User)
+async def signup_user(data: UserCreate, db: AsyncSession = Depends(get_db), redis: Redis = Depends(get_redis)):
+    if await get_user_by_email_or_username(db=db, email=data.email, username=data.username):
+        raise HTTPException(status_code=HTTPStatus.CONFLICT, detail=HTTPErrorDetails.CONFLICT.value)
+    await release_connection(db)
 
-@router.post('/login')
-async def login_user(email: Annotated[str, Form()], password: Annotated[str, Form()],
+    data.password_hash = await get_hashed_password_async(data.password_hash)
+    try:
+        user = await create_user(db=db, user=data)
+    except IntegrityError:
+        raise HTTPException(status_code=HTTPStatus.CONFLICT, detail=HTTPErrorDetails.CONFLICT.value)
+    await taken_names.publish(redis=redis, username=user.username, email=user.email)
+    return user
+
+
+@router.get('/availability', response_model=Availability)
+async def check_availability(username: Annotated[str | None, Query()] = None,
+                             email: Annotated[str | None, Query()] = None,
+                             db: AsyncSession = Depends(get_db)):
+    """Advisory check for registration forms, /signup stays the source of truth"""
+    availability = Availability()
+    if username is not None:
+        availability.username = not (taken_names.might_be_taken_username(username)
+                                     and await get_user_by_username(db=db, username=username))
+    if email is not None:
+        availability.email = not (taken_names.might_be_taken_email(email)
+                                  and await get_user_by_email(db=db, email=email))
+    return availability
+
+
+@router.post('/login', dependencies=[Depends(login_rate_limit)])
+async def login_user(email: Annotated[str, Form()], password: Annotated[str, Form()], background_tasks: BackgroundTasks,
                      db: AsyncSession = Depends(get_db), redis: Redis = Depends(get_redis), user_agent: str = Header()):
-    if not (user := await get_user_by_email(db=db, email=email)):
+    if not (user := await get_cached_user_by_email(db=db, email=email)):
         raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=HTTPErrorDetails.BAD_REQUEST.value)
-    if not verify_password(password=password, hashed_pass=user.password_hash):
+    await release_connection(db)
+    if not await verify_password_async(password=password, hashed_pass=user.password_hash):
         raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=HTTPErrorDetails.BAD_REQUEST.value)
+    if password_needs_update(user.password_hash):
+        background_tasks.add_task(_rehash_password, user_id=user.id, password=password, old_hash=user.password_hash)
 
     access, refresh = create_access_token(subject=user.id, useragent=user_agent), \
         create_refresh_token(subject=user.id, useragent=user_agent)
 
-    if old_refresh_model_instance := await get_token_by_ua_uid(db=db, useragent=user_agent, user_id=user.id):
-        await blacklisting(redis=redis, token=old_refresh_model_instance.refresh_token)
-        await update_token_by_ua_uid(db=db, new_token=refresh, user_id=user.id, useragent=user_agent)
-    else:
-        await create_token(db=db, refresh_token=refresh, useragent=user_agent, user_id=user.id)
+    if old_refresh := await upsert_token(db=db, jti=verify_token(refresh).jti, useragent=user_agent,
+                                         user_id=user.id):
+        await blacklisting(redis=redis, token=refresh_token_id(*old_refresh))
     return access, refresh
 
 
@@ -51,25 +93,72 @@ async def login_user(email: Annotated[str, Form()], password: Annotated[str, For
 async def reroll_tokens(refresh_token: Annotated[str, Body(embed=True)],
                         redis: Redis = Depends(get_redis), db: AsyncSession = Depends(get_db),
                         user_agent: str = Header()):
-    if not (token := JWTBearer.verify_jwt(refresh_token)) and await check_blacklist(redis, refresh_token):
+    if not (token := verify_token(refresh_token)) or await check_blacklist(redis, token):
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Invalid token or expired token.")
 
-    access, refresh = create_access_token(subject=token['sub'], useragent=user_agent), \
-        create_refresh_token(subject=token['sub'], useragent=user_agent)
-    await update_token_by_ua_uid(db=db, new_token=refresh, user_id=token['sub'], useragent=token['useragent'])
-    await blacklisting(redis=redis, token=refresh_token)
+    access, refresh = create_access_token(subject=token.sub, useragent=user_agent), \
+        create_refresh_token(subject=token.sub, useragent=user_agent)
+    try:
+        await upsert_token(db=db, jti=verify_token(refresh).jti, useragent=token.claims['useragent'],
+                           user_id=token.sub, expected_jti=token.jti)
+    except TokenReuseDetected as reuse:
+        # the presented token was already rotated: whoever holds the current one may have stolen it
+        await blacklisting_many(redis=redis, tokens=[token, *([refresh_token_id(*reuse.current)]
+                                                              if reuse.current else [])])
+        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Invalid token or expired token.")
+    except SessionsNotRecovered:
+        # Redis lost its sessions and the write-behind leader has not reloaded them yet, the token may well be valid
+        raise HTTPException(status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                            detail="Sessions are being restored, try again later.", headers={'Retry-After': '1'})
+    await blacklisting(redis=redis, token=token)
     return access, refresh
 
 
 @router.post('/logout')
-async def logout(access_token: Annotated[str, Depends(JWTBearer())], user_agent: str = Header(),
+async def logout(access_token: Annotated[VerifiedToken, Depends(JWTBearer())], user_agent: str = Header(),
                  redis: Redis = Depends(get_redis), db: AsyncSession = Depends(get_db)):
-    if not (access_payload := JWTBearer.verify_jwt(access_token)) and await check_blacklist(redis, access_token):
+    if await check_blacklist(redis, access_token):
         raise HTTPException(status_code=HTTPStatus.UNAUTHORIZED)
 
-    refresh_token_orm_instance = await get_token_by_ua_uid(db=db, useragent=user_agent,
-                                                           user_id=access_payload['sub'])
-    await blacklisting(redis=redis, token=refresh_token_orm_instance.refresh_token)
+    if refresh_token := await delete_token_by_ua_uid(db=db, useragent=user_agent, user_id=access_token.sub):
+        await blacklisting(redis=redis, token=refresh_token_id(*refresh_token))
     await blacklisting(redis=redis, token=access_token)
-    await delete_token(db=db, refresh_token=refresh_token_orm_instance.refresh_token)
     return HTTPStatus.OK
+
+
+@router.post('/logout-all')
+async def logout_all(access_token: Annotated[VerifiedToken, Depends(JWTBearer())],
+                     redis: Redis = Depends(get_redis), db: AsyncSession = Depends(get_db)):
+    """Revoke every session of the user. Sessions are deleted only after their tokens are blacklisted"""
+    if await check_blacklist(redis, access_token):
+        raise HTTPException(status_code=HTTPStatus.UNAUTHORIZED)
+
+    refresh_tokens = await delete_tokens_by_user_id(db=db, user_id=access_token.sub, commit=False)
+    if SETTINGS.BLACKLIST.REVOCATION_EPOCH_ENABLED:
+        await revoke_all_tokens(redis=redis, user_id=access_token.sub)
+    else:
+        await blacklisting_many(redis=redis, tokens=[*(refresh_token_id(*stored) for stored in refresh_tokens),
+                                                     access_token])
+    await db.commit()
+    return HTTPStatus.OK
+
+
+def introspection_client(x_introspection_key: Annotated[str | None, Header()] = None):
+    """Introspection is for services behind the gateway, they present one of INTROSPECT_CLIENT_KEYS"""
+    if not x_introspection_key or not any(hmac.compare_digest(x_introspection_key.encode(), key.encode())
+                                          for key in SETTINGS.JWT.INTROSPECT_CLIENT_KEYS):
+        raise HTTPException(status_code=HTTPStatus.UNAUTHORIZED, detail=HTTPErrorDetails.UNAUTHORIZED.value)
+
+
+@router.post('/introspect', response_model=None, dependencies=[Depends(introspection_client)])
+async def introspect_tokens(data: Introspection, redis: Redis = Depends(get_redis)) -> ORJSONResponse:
+    """
+    Check a batch of tokens at once, results come in the order of tokens:
+    `{"active": true, "sub", "jti", "exp", "iat", "token_type"}` or `{"active": false}`
+    """
+    inactive = {'active': False}
+    return ORJSONResponse([
+        {'active': True, 'sub': token.sub, 'jti': token.jti, 'exp': token.exp, 'iat': token.claims['iat'],
+         'token_type': token.claims.get('token_type')} if token else inactive
+        for token in await introspect(redis=redis, tokens=data.tokens)
+    ])
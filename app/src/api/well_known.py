@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Response
+
+from core.config import SETTINGS
+from services.keyring import keyring
+
+router = APIRouter()
+
+
+@router.get('/.well-known/jwks.json')
+async def jwks(response: Response):
+    response.headers['Cache-Control'] = f'public, max-age={SETTINGS.JWT.JWKS_MAX_AGE}'
+    return keyring.jwks()
@@ -1,12 +1,9 @@
 import enum
 import os
-from logging import config as logging_config
+from typing import Optional, Literal
 
 from dotenv import load_dotenv
 from pydantic import BaseSettings, BaseModel
-from .logger import LOGGING
-
-logging_config.dictConfig(LOGGING)
 
 DEBUG = True
 if DEBUG:
@@ -39,11 +36,28 @@ class DatabaseDSN(BaseSettings):
     POSTGRES_DB: str
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = False
+    DB_STATEMENT_CACHE_SIZE: int = 500
+    DB_COMPILED_CACHE_SIZE: int = 1000
+    DB_WARM_UP_CONNECTIONS: int = 0
 
 
 class RedisDSN(BaseSettings):
     REDIS_HOST: str
     REDIS_PORT: int
+    REDIS_MAX_CONNECTIONS: int = 200
+    REDIS_WARM_UP_CONNECTIONS: int = 0
+    # redis:// URLs of nodes holding blacklisted jti, empty keeps them on REDIS_HOST.
+    # A URL is the node identity on the hash ring, keep it unchanged while the node lives
+    REDIS_BLACKLIST_NODES: list[str] = []
+    # nodes before the last membership change, read until `manage.py rebalance-blacklist` has moved their keys.
+    # "main" is the main Redis and the default; equal to REDIS_BLACKLIST_NODES once keys are in place
+    REDIS_BLACKLIST_PREVIOUS_NODES: list[str] = []
+    REDIS_BLACKLIST_VNODES: int = 160
 
 
 class Project(BaseSettings):
@@ -59,6 +73,89 @@ class JWT(BaseSettings):
     ALGORITHM: str
     SECRET_KEY: str
     REFRESH_SECRET_KEY: str
+    JWT_CLAIMS_CACHE_SIZE: int = 10_000
+    JWT_KEYS_DIR: Optional[str] = None
+    JWT_SIGNING_KID: Optional[str] = None
+    JWKS_MAX_AGE: int = 300
+    INTROSPECT_MAX_TOKENS: int = 5000
+    INTROSPECT_CHUNK_SIZE: int = 500
+    # shared secrets of services allowed to call /introspect (X-Introspection-Key), empty disables the endpoint
+    INTROSPECT_CLIENT_KEYS: list[str] = []
+
+
+class PasswordHashing(BaseSettings):
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_MAX_PENDING: int = 64
+    # the first scheme hashes new passwords, hashes of the others are replaced on login
+    PASSWORD_HASH_SCHEMES: list[str] = ['bcrypt']
+    PASSWORD_BCRYPT_ROUNDS: int = 12
+    PASSWORD_ARGON2_TIME_COST: int = 3
+    PASSWORD_ARGON2_MEMORY_COST: int = 65536
+    PASSWORD_ARGON2_PARALLELISM: int = 1
+    PASSWORD_REHASH_ON_LOGIN: bool = True
+
+
+class Blacklist(BaseSettings):
+    BLACKLIST_CHANNEL: str = 'blacklist'
+    BLACKLIST_BLOOM_CAPACITY: int = 100_000
+    BLACKLIST_BLOOM_ERROR_RATE: float = 0.001
+    # revoked tokens expire within the longest token lifetime, split into this many filters by expiration
+    BLACKLIST_BLOOM_GENERATIONS: int = 8
+    BLACKLIST_PURGE_INTERVAL: int = 60
+    BLACKLIST_PIPELINE_SIZE: int = 1000
+    REVOCATION_EPOCH_ENABLED: bool = False
+    REVOCATION_EPOCH_CHANNEL: str = 'revocation_epoch'
+    REVOCATION_EPOCH_CACHE_SIZE: int = 100_000
+    # users with an epoch, i.e. who ran logout-all within the longest token lifetime
+    REVOCATION_EPOCH_BLOOM_CAPACITY: int = 10_000
+
+
+class Availability(BaseSettings):
+    AVAILABILITY_CHANNEL: str = 'users_taken'
+    AVAILABILITY_BLOOM_CAPACITY: int = 1_000_000
+    AVAILABILITY_BLOOM_ERROR_RATE: float = 0.01
+
+
+class UserCache(BaseSettings):
+    USER_CACHE_CHANNEL: str = 'user_cache'
+    USER_CACHE_SIZE: int = 10_000
+    USER_CACHE_LOCAL_TTL: int = 30
+    USER_CACHE_TTL: int = 300
+    # longer than a read-through miss takes from the Postgres read to the cache write
+    USER_CACHE_TOMBSTONE_TTL: int = 30
+
+
+class Sessions(BaseSettings):
+    SESSION_STORE: Literal['postgres', 'redis'] = 'postgres'
+    SESSION_WRITE_BEHIND_STREAM: str = 'sessions:write_behind'
+    SESSION_WRITE_BEHIND_BATCH_SIZE: int = 500
+    SESSION_WRITE_BEHIND_INTERVAL: float = 0.5
+    SESSION_WRITE_BEHIND_LOCK_TTL: int = 10
+    SESSION_SWEEP_ENABLED: bool = False
+    SESSION_SWEEP_INTERVAL: int = 300
+    SESSION_SWEEP_BATCH_SIZE: int = 1000
+    SESSION_SWEEP_PAUSE: float = 0.1
+    SESSION_SWEEP_LOCK_TIMEOUT_MS: int = 100
+
+
+class RateLimit(BaseSettings):
+    LOGIN_RATE_LIMIT_ENABLED: bool = True
+    LOGIN_RATE_IP_LIMIT: int = 20
+    LOGIN_RATE_IP_WINDOW: int = 60
+    LOGIN_RATE_EMAIL_LIMIT: int = 10
+    LOGIN_RATE_EMAIL_WINDOW: int = 300
+    LOGIN_RATE_GLOBAL_LIMIT: int = 500
+    LOGIN_RATE_GLOBAL_WINDOW: int = 1
+    LOGIN_RATE_BLOCKED_CACHE_SIZE: int = 100_000
+    # addresses or networks of reverse proxies whose X-Forwarded-For is trusted to name the client
+    TRUSTED_PROXIES: list[str] = []
+
+
+class Logs(BaseSettings):
+    LOG_LEVEL: str = 'INFO'
+    LOG_QUEUE_SIZE: int = 10_000
+    # share of successful requests written to the access log, errors are always written
+    ACCESS_LOG_SAMPLE_RATE: float = 1.0
 
 
 class Settings(BaseSettings):
@@ -66,6 +163,13 @@ class Settings(BaseSettings):
     PROJECT: Project = Project()
     REDIS: RedisDSN = RedisDSN()
     JWT: JWT = JWT()
+    PASSWORD: PasswordHashing = PasswordHashing()
+    BLACKLIST: Blacklist = Blacklist()
+    AVAILABILITY: Availability = Availability()
+    USER_CACHE: UserCache = UserCache()
+    SESSIONS: Sessions = Sessions()
+    RATE_LIMIT: RateLimit = RateLimit()
+    LOGS: Logs = Logs()
 
     SQLALCHEMY_DATABASE_URL = \
         f"postgresql+asyncpg://{DB.POSTGRES_USER}:{DB.POSTGRES_PASSWORD}@{DB.POSTGRES_HOST}:{DB.POSTGRES_PORT}/{DB.POSTGRES_DB}"
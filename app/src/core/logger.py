@@ -1,57 +1,182 @@
-LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-LOG_DEFAULT_HANDLERS = ['console', ]
+"""
+Logging off the event loop: loggers merge the message of a record and put it to a bounded queue, a listener thread
+formats records as JSON lines and writes them to stdout. A record is created only if some logger level let it
+through, and when the queue is full it is dropped instead of blocking the request.
+Every record carries `request_id` of the request it was logged in (RequestIdMiddleware).
+"""
+import contextvars
+import copy
+import logging
+import queue
+import random
+import uuid
+from datetime import datetime, timezone
+from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+from core.config import SETTINGS
+from core.metrics import LOG_RECORDS_DROPPED
+
+REQUEST_ID_HEADER = b'x-request-id'
+MAX_REQUEST_ID_LENGTH = 128
+
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar('request_id', default='-')
+
+# attributes every LogRecord has, anything else was passed in `extra` and goes to the JSON line
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {
+    'message', 'asctime', 'request_id', 'color_message',
+}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', '-'),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                line[key] = value
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line['exc_info'] = record.exc_text
+        return orjson.dumps(line, default=str).decode()
+
+
+_exception_formatter = logging.Formatter()
+
+
+class RequestIdFilter(logging.Filter):
+    """Capture request ID in the logging thread, the listener thread has no request context"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class AccessLogSampler(logging.Filter):
+    """Let through ACCESS_LOG_SAMPLE_RATE of uvicorn access records with status below 400"""
+
+    def __init__(self, rate: float = None):
+        super().__init__()
+        self.rate = SETTINGS.LOGS.ACCESS_LOG_SAMPLE_RATE if rate is None else rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1:
+            return True
+        # uvicorn access record args: client_addr, method, full_path, http_version, status_code
+        status = record.args[4] if isinstance(record.args, tuple) and len(record.args) == 5 else 500
+        return status >= 400 or random.random() < self.rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue the record with its message merged, the listener formats it as JSON; a full queue drops the record"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Arguments and traceback are read now, in the logging thread, since they may change before the listener
+        gets to them (SQL parameters, ORM instances)"""
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class RequestIdMiddleware:
+    """Pure ASGI middleware taking request ID from X-Request-ID (or generating one) and echoing it back"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        request_id = next((value.decode('latin-1')[:MAX_REQUEST_ID_LENGTH] for name, value in scope['headers']
+                           if name == REQUEST_ID_HEADER), None) or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message: Message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', ()), (REQUEST_ID_HEADER, request_id.encode('latin-1'))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
+
 
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
-        'verbose': {
-            'format': LOG_FORMAT
+        'json': {
+            '()': JSONFormatter,
         },
-        'default': {
-            '()': 'uvicorn.logging.DefaultFormatter',
-            'fmt': '%(levelprefix)s %(message)s',
-            'use_colors': None,
-        },
-        'access': {
-            '()': 'uvicorn.logging.AccessFormatter',
-            'fmt': "%(levelprefix)s %(client_addr)s - '%(request_line)s' %(status_code)s",
+    },
+    'filters': {
+        'access_sampler': {
+            '()': AccessLogSampler,
         },
     },
     'handlers': {
         'console': {
             'level': 'DEBUG',
             'class': 'logging.StreamHandler',
-            'formatter': 'verbose',
-        },
-        'default': {
-            'formatter': 'default',
-            'class': 'logging.StreamHandler',
-            'stream': 'ext://sys.stdout',
-        },
-        'access': {
-            'formatter': 'access',
-            'class': 'logging.StreamHandler',
+            'formatter': 'json',
             'stream': 'ext://sys.stdout',
         },
     },
     'loggers': {
-        '': {
-            'handlers': LOG_DEFAULT_HANDLERS,
-            'level': 'INFO',
-        },
         'uvicorn.error': {
             'level': 'INFO',
         },
         'uvicorn.access': {
-            'handlers': ['access'],
+            'handlers': ['console'],
+            'filters': ['access_sampler'],
             'level': 'INFO',
             'propagate': False,
         },
+        'sqlalchemy.engine': {
+            'level': 'INFO' if SETTINGS.ORM_ECHO else 'WARNING',
+        },
     },
     'root': {
-        'level': 'INFO',
-        'formatter': 'verbose',
-        'handlers': LOG_DEFAULT_HANDLERS,
+        'level': SETTINGS.LOGS.LOG_LEVEL,
+        'handlers': ['console'],
     },
-}
\ No newline at end of file
+}
+
+
+def setup_logging() -> QueueListener:
+    """
+    Apply LOGGING, then move handlers of the configured loggers behind one queue handler.
+    The caller stops the returned listener on shutdown, which writes out what is left in the queue.
+    """
+    dictConfig(LOGGING)
+    queue_handler = DeferredQueueHandler(queue.Queue(maxsize=SETTINGS.LOGS.LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RequestIdFilter())
+    handlers = []
+    for logger in [logging.getLogger(), *map(logging.getLogger, LOGGING['loggers'])]:
+        if logger.handlers:
+            handlers.extend(handler for handler in logger.handlers if handler not in handlers)
+            logger.handlers = [queue_handler]
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
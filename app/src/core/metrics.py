@@ -0,0 +1,95 @@
+"""
+Prometheus metrics. With PROMETHEUS_MULTIPROC_DIR set (see entrypoint.sh) every gunicorn worker writes its samples
+to shared files and /metrics aggregates all workers.
+"""
+import os
+import re
+import time
+from functools import lru_cache
+
+from prometheus_client import Histogram, Gauge, Counter, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.multiprocess import MultiProcessCollector
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency',
+                            ['method', 'route', 'status'])
+SQL_LATENCY = Histogram('db_statement_duration_seconds', 'SQL statement execution time',
+                        ['operation', 'table'], buckets=FAST_BUCKETS)
+DB_POOL_CHECKOUT_WAIT = Histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a DB pool connection',
+                                  buckets=FAST_BUCKETS)
+DB_POOL_HOLD = Histogram('db_pool_hold_seconds', 'Time a DB connection stays checked out of the pool',
+                         buckets=FAST_BUCKETS)
+DB_REQUEST_POOL_HOLD = Histogram('db_request_pool_hold_seconds', 'Total DB connection hold time of one request',
+                                 buckets=FAST_BUCKETS)
+DB_POOL_CONNECTIONS = Gauge('db_pool_connections', 'DB pool connections by state, summed over live workers',
+                            ['state'], multiprocess_mode='livesum')
+REDIS_LATENCY = Histogram('redis_command_duration_seconds', 'Redis command or pipeline round trip time',
+                          ['command'], buckets=FAST_BUCKETS)
+REDIS_POOL_CHECKOUT_WAIT = Histogram('redis_pool_checkout_wait_seconds', 'Time spent getting a Redis connection',
+                                     buckets=FAST_BUCKETS)
+PASSWORD_HASH_LATENCY = Histogram('password_hash_duration_seconds', 'Password hash/verify time including queueing',
+                                  ['operation'])
+SESSION_WRITE_BEHIND_LAG = Histogram('session_write_behind_lag_seconds',
+                                    'Time from a session change in Redis to its commit to Postgres',
+                                    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+SESSIONS_SWEPT = Counter('refresh_sessions_swept_total', 'Expired refresh sessions deleted by the sweeper')
+LOG_RECORDS_DROPPED = Counter('log_records_dropped_total', 'Log records dropped because the log queue was full')
+RATE_LIMITED = Counter('rate_limited_requests_total', 'Requests rejected by rate limiter',
+                       ['scope', 'source'])
+
+_WRITE_RE = re.compile(r'\b(INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+([\w."]+)', re.IGNORECASE)
+_READ_RE = re.compile(r'\bFROM\s+([\w."]+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def statement_labels(statement: str) -> tuple[str, str]:
+    """Reduce SQL statement to (operation, table) labels, keeping metric cardinality bounded"""
+    if match := _WRITE_RE.search(statement):
+        return match.group(1).split()[0].upper(), match.group(2).replace('"', '')
+    if match := _READ_RE.search(statement):
+        return 'SELECT', match.group(1).replace('"', '')
+    return (statement.split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'), ''
+
+
+def render_metrics() -> tuple[bytes, str]:
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware observing request latency labelled by route template"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._routes = None
+
+    def _route_path(self, scope: Scope) -> str:
+        if self._routes is None:
+            self._routes = {route.endpoint: route.path for route in scope['app'].routes if hasattr(route, 'endpoint')}
+        return self._routes.get(scope.get('endpoint'), 'unmatched')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_LATENCY.labels(scope['method'], self._route_path(scope), status).observe(
+                time.perf_counter() - started
+            )
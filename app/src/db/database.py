@@ -1,20 +1,138 @@
+import time
+from typing import Optional
+
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncEngine, async_sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy import create_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 
 from core.config import SETTINGS
+from core.metrics import SQL_LATENCY, DB_POOL_CHECKOUT_WAIT, DB_POOL_CONNECTIONS, DB_POOL_HOLD, \
+    DB_REQUEST_POOL_HOLD, statement_labels
 
-engine = create_async_engine(SETTINGS.SQLALCHEMY_DATABASE_URL, echo=SETTINGS.ORM_ECHO)
-engine_sync = create_engine(SETTINGS.SQLALCHEMY_DATABASE_URL_SYNC)
-async_session = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
 Base = declarative_base()
 
+_engine: Optional[AsyncEngine] = None
+_session_factory: Optional[async_sessionmaker] = None
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Pool observing how long a checkout waits for a free connection"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+def get_engine() -> AsyncEngine:
+    """Engine is created on first use, so every worker builds its own pool after fork.
+    ORM_ECHO is applied as the level of `sqlalchemy.engine` logger (core/logger.py) rather than `echo`,
+    which would attach a synchronous handler of its own"""
+    global _engine
+    if _engine is None:
+        _engine = create_async_engine(
+            SETTINGS.SQLALCHEMY_DATABASE_URL,
+            poolclass=InstrumentedQueuePool,
+            pool_size=SETTINGS.DB.DB_POOL_SIZE,
+            max_overflow=SETTINGS.DB.DB_MAX_OVERFLOW,
+            pool_timeout=SETTINGS.DB.DB_POOL_TIMEOUT,
+            pool_recycle=SETTINGS.DB.DB_POOL_RECYCLE,
+            pool_pre_ping=SETTINGS.DB.DB_POOL_PRE_PING,
+            query_cache_size=SETTINGS.DB.DB_COMPILED_CACHE_SIZE,
+            connect_args={'prepared_statement_cache_size': SETTINGS.DB.DB_STATEMENT_CACHE_SIZE},
+        )
+        _instrument(_engine)
+    return _engine
+
+
+def async_session() -> AsyncSession:
+    global _session_factory
+    if _session_factory is None:
+        _session_factory = async_sessionmaker(bind=get_engine(), class_=AsyncSession, expire_on_commit=False,
+                                              autoflush=False)
+    return _session_factory()
+
+
+async def dispose_engine():
+    global _engine, _session_factory
+    if _engine is not None:
+        await _engine.dispose()
+        _engine, _session_factory = None, None
+
+
+def pool_stats() -> dict:
+    pool = get_engine().pool
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+    }
+
+
+def _update_pool_stats():
+    for state, value in pool_stats().items():
+        DB_POOL_CONNECTIONS.labels(state).set(value)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    SQL_LATENCY.labels(*statement_labels(statement)).observe(time.perf_counter() - context._metrics_started)
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info['checked_out_at'] = time.perf_counter()
+    _update_pool_stats()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    if (checked_out_at := connection_record.info.pop('checked_out_at', None)) is not None:
+        DB_POOL_HOLD.observe(time.perf_counter() - checked_out_at)
+    _update_pool_stats()
+
+
+def _instrument(engine: AsyncEngine):
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine.sync_engine, 'checkout', _on_checkout)
+    event.listen(engine.sync_engine, 'checkin', _on_checkin)
+
+
+@event.listens_for(Session, 'after_begin')
+def _on_session_begin(session, transaction, connection):
+    session.info.setdefault('connection_acquired_at', time.perf_counter())
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _on_session_transaction_end(session, transaction):
+    if transaction.parent is None and (acquired_at := session.info.pop('connection_acquired_at', None)):
+        session.info['connection_hold'] = session.info.get('connection_hold', 0.0) + time.perf_counter() - acquired_at
+
 
 async def get_db() -> AsyncSession:
+    """
+    Session checks out a connection lazily on the first query and returns it to the pool when its transaction ends,
+    so handlers call `release_connection` before CPU-bound work instead of holding an idle connection.
+    Total connection hold time of the request is observed on exit.
+    """
     async with async_session() as session:
-        yield session
+        try:
+            yield session
+        finally:
+            await session.close()
+            DB_REQUEST_POOL_HOLD.observe(session.info.pop('connection_hold', 0.0))
 
 
+async def release_connection(db: AsyncSession):
+    """End current transaction and return its connection to the pool, next query checks out a connection again"""
+    if db.in_transaction():
+        await db.commit()
@@ -1,10 +1,76 @@
+import asyncio
+import hashlib
+import time
 from typing import Optional
 
-from redis import asyncio as aioredis
 from redis.asyncio import Redis, ConnectionPool
+from redis.asyncio.client import Pipeline
+from redis.exceptions import NoScriptError
+
+from core.config import SETTINGS
+from core.metrics import REDIS_LATENCY, REDIS_POOL_CHECKOUT_WAIT
+
+
+class InstrumentedConnectionPool(ConnectionPool):
+    async def get_connection(self, command_name, *keys, **options):
+        started = time.perf_counter()
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        finally:
+            REDIS_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error=raise_on_error)
+        finally:
+            REDIS_LATENCY.labels('PIPELINE').observe(time.perf_counter() - started)
+
+
+class InstrumentedRedis(Redis):
+    """Redis client observing round trip time of every command and pipeline"""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(str(args[0]).upper()).observe(time.perf_counter() - started)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> Pipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class LuaScript:
+    """Lua script called by its SHA1, the body is sent only when Redis does not have it cached yet"""
+
+    def __init__(self, body: str):
+        self.body = body
+        self.sha = hashlib.sha1(body.encode()).hexdigest()
+
+    async def __call__(self, redis: Redis, keys: tuple = (), args: tuple = ()):
+        try:
+            return await redis.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            return await redis.eval(self.body, len(keys), *keys, *args)
+
 
 redis_pool: Optional[ConnectionPool] = None
 
 
+def create_redis_pool() -> ConnectionPool:
+    return InstrumentedConnectionPool(host=SETTINGS.REDIS.REDIS_HOST, port=SETTINGS.REDIS.REDIS_PORT, db=0,
+                                      max_connections=SETTINGS.REDIS.REDIS_MAX_CONNECTIONS)
+
+
+async def warm_up_redis_pool(connections: int):
+    """Open `connections` pool connections at once and put them back, so first requests skip connect"""
+    opened = await asyncio.gather(*(redis_pool.get_connection('PING') for _ in range(connections)))
+    for connection in opened:
+        await redis_pool.release(connection)
+
+
 async def get_redis() -> Redis:
-    return aioredis.Redis(connection_pool=redis_pool, decode_responses=True)
+    return InstrumentedRedis(connection_pool=redis_pool, decode_responses=True)
@@ -1,18 +1,53 @@
 import logging
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
 from fastapi.responses import ORJSONResponse
-from redis import asyncio as aioredis
 
+from api import metrics, well_known
 from api.v1 import auth
 from core.config import SETTINGS
-from core.logger import LOGGING
+from core.logger import LOGGING, RequestIdMiddleware, setup_logging
+from core.metrics import MetricsMiddleware
 from db import redis_inj
+from db.database import dispose_engine
+from services.blacklist import filter_purger
+from services.blacklist_store import blacklist_store
+from services.broadcast import broadcast
+from services.crud.warm_up import warm_up_statements
+from services.password import warm_up_password_executor, shutdown_password_executor
+from services.session_sweeper import session_sweeper
+from services.session_write_behind import session_write_behind
 
 
-redis_inj.redis_pool = aioredis.ConnectionPool(
-    host=SETTINGS.REDIS.REDIS_HOST, port=SETTINGS.REDIS.REDIS_PORT, db=0, max_connections=200)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Per-worker resources are created here rather than at import, so `gunicorn --preload` forks a clean master"""
+    log_listener = setup_logging()
+    if redis_inj.redis_pool is None:
+        redis_inj.redis_pool = redis_inj.create_redis_pool()
+    await redis_inj.warm_up_redis_pool(connections=SETTINGS.REDIS.REDIS_WARM_UP_CONNECTIONS)
+    await warm_up_statements(connections=SETTINGS.DB.DB_WARM_UP_CONNECTIONS)
+    await warm_up_password_executor()
+    blacklist_store.configure(main=await redis_inj.get_redis())
+    broadcast.start(await redis_inj.get_redis())
+    filter_purger.start()
+    if SETTINGS.SESSIONS.SESSION_STORE == 'redis':
+        session_write_behind.start(await redis_inj.get_redis())
+    if SETTINGS.SESSIONS.SESSION_SWEEP_ENABLED:
+        session_sweeper.start(await redis_inj.get_redis())
+    yield
+    await session_sweeper.stop(await redis_inj.get_redis())
+    await session_write_behind.stop(await redis_inj.get_redis())
+    await broadcast.stop()
+    await filter_purger.stop()
+    await blacklist_store.close()
+    shutdown_password_executor()
+    await redis_inj.redis_pool.disconnect()
+    redis_inj.redis_pool = None
+    await dispose_engine()
+    log_listener.stop()
 
 
 app = FastAPI(
@@ -20,10 +55,15 @@ app = FastAPI(
     docs_url='/api/openapi',
     openapi_url='/api/openapi.json',
     default_response_class=ORJSONResponse,
-
+    lifespan=lifespan,
 )
 
 app.include_router(auth.router, prefix='/api/v1/auth', tags=['auth'])
+app.include_router(well_known.router, tags=['well-known'])
+app.include_router(metrics.router)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestIdMiddleware)
+
 
 if __name__ == '__main__':
     uvicorn.run(
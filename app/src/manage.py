@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+
+from core.config import SETTINGS
+
+
+def calibrate_password_hash(args):
+    from services.password import calibrate
+
+    settings, seconds = calibrate(scheme=args.scheme, target_seconds=args.target_ms / 1000, samples=args.samples)
+    print(f'# {args.scheme}: {seconds * 1000:.0f} ms per hash on this host, target {args.target_ms} ms')
+    for name, value in settings.items():
+        print(f'{name}={value}')
+    print(f'PASSWORD_HASH_SCHEMES=["{args.scheme}"'
+          + ''.join(f', "{scheme}"' for scheme in SETTINGS.PASSWORD.PASSWORD_HASH_SCHEMES if scheme != args.scheme)
+          + ']')
+
+
+def sweep_sessions(args):
+    from db.database import dispose_engine
+    from services.session_sweeper import sweep_expired_sessions
+
+    async def sweep():
+        try:
+            return await sweep_expired_sessions()
+        finally:
+            await dispose_engine()
+
+    print(f'Deleted {asyncio.run(sweep())} expired refresh sessions')
+
+
+def rebalance_blacklist(args):
+    from db import redis_inj
+    from services.blacklist_store import blacklist_store
+
+    async def rebalance():
+        redis_inj.redis_pool = redis_inj.create_redis_pool()
+        blacklist_store.configure(main=await redis_inj.get_redis())
+        try:
+            return await blacklist_store.rebalance()
+        finally:
+            await blacklist_store.close()
+            await redis_inj.redis_pool.disconnect()
+
+    print(f'Moved {asyncio.run(rebalance())} blacklisted tokens to their nodes')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python manage.py', description='Auth service maintenance commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    calibrate = commands.add_parser('calibrate-password-hash',
+                                    help='pick password hash cost for a target hash time on this host')
+    calibrate.add_argument('--scheme', choices=('bcrypt', 'argon2'), default=SETTINGS.PASSWORD.PASSWORD_HASH_SCHEMES[0])
+    calibrate.add_argument('--target-ms', type=float, default=250)
+    calibrate.add_argument('--samples', type=int, default=3, help='hashes timed per cost, the median is used')
+    calibrate.set_defaults(handler=calibrate_password_hash)
+
+    sweep = commands.add_parser('sweep-sessions', help='delete refresh sessions whose token has expired')
+    sweep.set_defaults(handler=sweep_sessions)
+
+    rebalance = commands.add_parser('rebalance-blacklist',
+                                    help='move blacklisted tokens to their nodes after REDIS_BLACKLIST_NODES changed')
+    rebalance.set_defaults(handler=rebalance_blacklist)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,8 @@ import re
 import uuid
 import enum
 
-from sqlalchemy import Column, Integer, DateTime, Enum, String, ForeignKey, Float, Boolean, Index, UniqueConstraint
+from sqlalchemy import Column, Integer, DateTime, Enum, String, ForeignKey, Float, Boolean, Index, UniqueConstraint, \
+    LargeBinary, func
 from sqlalchemy_utils.types.uuid import UUIDType
 from sqlalchemy.orm import relationship, validates
 
@@ -20,6 +21,12 @@ class DefaultMixin:
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+PASSWORD_HASH_PATTERNS = (
+    re.compile(r'^\$2[ayb]\$.{56}$'),
+    re.compile(r'^\$argon2(id|i|d)\$v=\d+\$m=\d+,t=\d+,p=\d+\$[A-Za-z0-9+/]+\$[A-Za-z0-9+/]+$'),
+)
+
+
 class HTTPErrorDetails(enum.Enum):
     NOT_FOUND = 'Not found this entity'
     NOT_ACCEPTABLE = 'This operation is not available for this entity'
@@ -27,6 +34,7 @@ class HTTPErrorDetails(enum.Enum):
     BAD_REQUEST = 'Invalid data provided'
     CONFLICT = 'Provided data already exists'
     UNAUTHORIZED = 'You are not authorized for this request'
+    TOO_MANY_REQUESTS = 'Too many requests, try again later'
 
 
 class Users(DefaultMixin, Base):
@@ -53,18 +61,23 @@ class Users(DefaultMixin, Base):
     def validate_password_hash(self, key, value):
         if not value:
             raise AssertionError('No password hash provided')
-        if not re.match(r'^\$2[ayb]\$.{56}$', value):
-            raise AssertionError('Provided password hash is not a bcrypt hash')
+        if not any(pattern.match(value) for pattern in PASSWORD_HASH_PATTERNS):
+            raise AssertionError('Provided password hash is not a bcrypt or argon2 hash')
         return value
 
 
 class RefreshTokens(DefaultMixin, Base):
     __tablename__ = 'refresh_tokens'
-    __table_args__ = (UniqueConstraint('useragent', 'user_id', name='ua_user_uniq_constr'),
+    __table_args__ = (UniqueConstraint('user_id', 'ua_fingerprint', name='ua_fingerprint_user_uniq_constr'),
                       {'schema': 'content'},
                       )
 
-    refresh_token = Column(String, nullable=False, unique=True)
+    jti = Column(UUIDType(binary=False), nullable=False, unique=True)
     useragent = Column(String, nullable=False)
+    # services.useragent.ua_fingerprint of useragent, sessions are looked up by it
+    ua_fingerprint = Column(LargeBinary(16), nullable=False)
     user_id = Column(UUIDType(binary=False), ForeignKey('content.users.id', ondelete='CASCADE'), nullable=False)
 
+
+# expiration of a session is counted from this expression, see services/crud/refresh_tokens.py
+Index('ix_content_refresh_tokens_issued_at', func.coalesce(RefreshTokens.updated_at, RefreshTokens.created_at))
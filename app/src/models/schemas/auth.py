@@ -1,7 +1,9 @@
 import uuid as builtin_uuid
 from typing import Optional
 
+from pydantic import Field
 
+from core.config import SETTINGS
 from models.schemas.base import BaseSchemaModel, BaseFullModelMixin
 
 
@@ -31,3 +33,12 @@ class User(UserBase, BaseFullModelMixin):
 
     class Config:
         orm_mode = True
+
+
+class Availability(BaseSchemaModel):
+    username: Optional[bool]
+    email: Optional[bool]
+
+
+class Introspection(BaseSchemaModel):
+    tokens: list[str] = Field(..., max_items=SETTINGS.JWT.INTROSPECT_MAX_TOKENS)
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from typing import Optional
+
+from redis.asyncio.client import Redis
+from sqlalchemy import select, func
+
+from core.config import SETTINGS
+from db.database import async_session
+from models.models import Users as UserModel
+from services.bloom import BloomFilter
+from services.broadcast import broadcast
+
+logger = logging.getLogger(__name__)
+
+WARM_UP_BATCH_SIZE = 10_000
+WARM_UP_RETRY_SECONDS = 5
+
+
+def _username_key(username: str) -> str:
+    return f'u:{username}'
+
+
+def _email_key(email: str) -> str:
+    return f'e:{email}'
+
+
+class TakenNamesFilter:
+    """
+    Per-worker Bloom filter of taken usernames and emails.
+    "Not in the filter" means the value is definitely available, otherwise the caller must ask Postgres.
+    Signups in other workers arrive via pub/sub; while not in sync every lookup goes to Postgres.
+    The filter is rebuilt after every pub/sub (re)connect in a task of its own, retried until Postgres answers.
+    """
+
+    def __init__(self):
+        self._filter = BloomFilter(capacity=SETTINGS.AVAILABILITY.AVAILABILITY_BLOOM_CAPACITY,
+                                   error_rate=SETTINGS.AVAILABILITY.AVAILABILITY_BLOOM_ERROR_RATE)
+        self.ready = False
+        self._pending: Optional[list[tuple[str, str]]] = None
+        self._warm_up_task: Optional[asyncio.Task] = None
+
+    def add(self, username: str, email: str):
+        self._filter.add(_username_key(username))
+        self._filter.add(_email_key(email))
+        if self._pending is not None:
+            self._pending.append((username, email))
+
+    def might_be_taken_username(self, username: str) -> bool:
+        return not self.ready or _username_key(username) in self._filter
+
+    def might_be_taken_email(self, email: str) -> bool:
+        return not self.ready or _email_key(email) in self._filter
+
+    def on_message(self, data: str):
+        username, email = data.split('\n')
+        self.add(username, email)
+
+    async def on_connect(self, redis: Redis = None):
+        """Start rebuilding the filter in its own task, so a slow or failing Postgres does not hold up pub/sub"""
+        self._cancel_warm_up()
+        self._warm_up_task = asyncio.create_task(self._warm_up_until_done())
+
+    async def _warm_up_until_done(self):
+        while True:
+            try:
+                await self.warm_up()
+                return
+            except Exception:
+                logger.exception('Taken names warm up failed, retrying in %s s', WARM_UP_RETRY_SECONDS)
+            await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+
+    async def warm_up(self):
+        """Rebuild filter from content.users, sized for twice the current number of users.
+        Signups announced while the table is read are added to the new filter as well"""
+        self.ready = False
+        self._pending = []
+        try:
+            async with async_session() as db:
+                users_count = (await db.execute(select(func.count()).select_from(UserModel))).scalar()
+                taken = BloomFilter(
+                    capacity=max(SETTINGS.AVAILABILITY.AVAILABILITY_BLOOM_CAPACITY, users_count * 2),
+                    error_rate=SETTINGS.AVAILABILITY.AVAILABILITY_BLOOM_ERROR_RATE
+                )
+                rows = await db.stream(
+                    select(UserModel.username, UserModel.email).execution_options(yield_per=WARM_UP_BATCH_SIZE)
+                )
+                async for username, email in rows:
+                    taken.add(_username_key(username))
+                    taken.add(_email_key(email))
+            self._filter, pending, self._pending = taken, self._pending, None
+            for username, email in pending:
+                self.add(username, email)
+        finally:
+            self._pending = None
+        self.ready = True
+
+    def _cancel_warm_up(self):
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            self._warm_up_task = None
+
+    def on_disconnect(self):
+        self._cancel_warm_up()
+        self.ready = False
+
+    async def publish(self, redis: Redis, username: str, email: str):
+        self.add(username, email)
+        await redis.publish(SETTINGS.AVAILABILITY.AVAILABILITY_CHANNEL, f'{username}\n{email}')
+
+
+taken_names = TakenNamesFilter()
+broadcast.subscribe(SETTINGS.AVAILABILITY.AVAILABILITY_CHANNEL, on_message=taken_names.on_message,
+                    on_connect=taken_names.on_connect, on_disconnect=taken_names.on_disconnect)
@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from redis.asyncio.client import Redis
+
+from core.config import SETTINGS
+from services.blacklist_store import blacklist_store
+from services.bloom import ExpiringBloomFilter
+from services.broadcast import broadcast
+
+logger = logging.getLogger(__name__)
+
+EPOCH_KEY_PREFIX = 'revoked_before:'
+WARM_UP_BATCH_SIZE = 1000
+WARM_UP_RETRY_SECONDS = 5
+
+
+def revocation_filter(capacity: int) -> ExpiringBloomFilter:
+    """Expiring filter for revocations, none of which outlives the longest token lifetime"""
+    return ExpiringBloomFilter(
+        capacity=capacity,
+        error_rate=SETTINGS.BLACKLIST.BLACKLIST_BLOOM_ERROR_RATE,
+        lifetime=60 * max(SETTINGS.JWT.ACCESS_TOKEN_EXPIRE_MINUTES, SETTINGS.JWT.REFRESH_TOKEN_EXPIRE_MINUTES),
+        generations=SETTINGS.BLACKLIST.BLACKLIST_BLOOM_GENERATIONS,
+    )
+
+
+class RevokedTokensCache:
+    """
+    Per-worker negative cache of revoked jti.
+    "Not in the filter" means the token is definitely not revoked and Redis is not asked,
+    otherwise the caller must confirm revocation in Redis. While the filter is not in sync with Redis
+    (before warm up or after pub/sub disconnect) every lookup goes to Redis.
+    The filter is loaded after every pub/sub (re)connect in a task of its own, retried until every node answers.
+    """
+
+    def __init__(self):
+        self._filter = revocation_filter(capacity=SETTINGS.BLACKLIST.BLACKLIST_BLOOM_CAPACITY)
+        self.ready = False
+        self._warm_up_task: Optional[asyncio.Task] = None
+        self.lookups = 0
+        self.local_hits = 0
+        self.redis_lookups = 0
+        self.false_positives = 0
+
+    def add(self, jti: str, exp: int):
+        self._filter.add(str(jti), exp)
+
+    def might_be_revoked(self, jti: str) -> bool:
+        self.lookups += 1
+        if self.ready and str(jti) not in self._filter:
+            self.local_hits += 1
+            return False
+        self.redis_lookups += 1
+        return True
+
+    def record_redis_answer(self, revoked: bool):
+        if self.ready and not revoked:
+            self.false_positives += 1
+
+    def on_message(self, data: str):
+        """Message is one `<jti> <exp>` pair per line"""
+        for line in data.splitlines():
+            jti, exp = line.split(' ')
+            self.add(jti, int(exp))
+
+    async def on_connect(self, redis: Redis = None):
+        """Start loading the filter in its own task, so a slow or unreachable node does not hold up pub/sub"""
+        self._cancel_warm_up()
+        self._warm_up_task = asyncio.create_task(self._warm_up_until_done())
+
+    async def _warm_up_until_done(self):
+        while True:
+            try:
+                await self.warm_up()
+                return
+            except Exception:
+                logger.exception('Revoked tokens warm up failed, retrying in %s s', WARM_UP_RETRY_SECONDS)
+            await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+
+    async def warm_up(self):
+        """Load every revoked jti from the blacklist nodes into a fresh filter.
+        Tokens are written to the nodes before they are announced, so the ones announced meanwhile are not lost"""
+        self.ready = False
+        self._filter.clear()
+        async for batch in blacklist_store.scan_ttls():
+            now = time.time()
+            for jti, ttl in batch:
+                if ttl > 0:
+                    self.add(jti, int(now + ttl) + 1)
+        self.ready = True
+
+    def _cancel_warm_up(self):
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            self._warm_up_task = None
+
+    def on_disconnect(self):
+        self._cancel_warm_up()
+        self.ready = False
+
+    def purge(self):
+        self._filter.purge()
+
+    def stats(self) -> dict:
+        return {
+            'ready': self.ready,
+            'size': len(self._filter),
+            'lookups': self.lookups,
+            'local_hits': self.local_hits,
+            'redis_lookups': self.redis_lookups,
+            'false_positives': self.false_positives,
+            'hit_rate': self.local_hits / self.lookups if self.lookups else 0.0,
+        }
+
+
+def epoch_key(user_id: str) -> str:
+    return f'{EPOCH_KEY_PREFIX}{user_id}'
+
+
+class RevocationEpochs:
+    """
+    Per-worker cache of per-user revocation epochs: every token of the user issued before the epoch is revoked.
+    Users that have an epoch are kept in a Bloom filter, so users that never revoked all their sessions
+    are answered without network. Epochs themselves live in a bounded LRU in front of Redis.
+    """
+
+    def __init__(self):
+        self._filter = revocation_filter(capacity=SETTINGS.BLACKLIST.REVOCATION_EPOCH_BLOOM_CAPACITY)
+        self._epochs: OrderedDict[str, int] = OrderedDict()
+        self.ready = False
+        self.lookups = 0
+        self.local_hits = 0
+        self.redis_lookups = 0
+
+    def add(self, user_id: str, epoch: int, expires_at: int):
+        self._filter.add(str(user_id), expires_at)
+        self._remember(str(user_id), epoch)
+
+    def _remember(self, user_id: str, epoch: int):
+        self._epochs[user_id] = epoch
+        self._epochs.move_to_end(user_id)
+        if len(self._epochs) > SETTINGS.BLACKLIST.REVOCATION_EPOCH_CACHE_SIZE:
+            self._epochs.popitem(last=False)
+
+    def _get_local(self, user_id: str) -> Optional[int]:
+        """Epoch of user (0 for no epoch) when it is known without Redis, None when Redis must be asked"""
+        self.lookups += 1
+        if self.ready:
+            if user_id not in self._filter:
+                self.local_hits += 1
+                return 0
+            if (epoch := self._epochs.get(user_id)) is not None:
+                self.local_hits += 1
+                self._epochs.move_to_end(user_id)
+                return epoch
+        self.redis_lookups += 1
+        return None
+
+    async def get(self, redis: Redis, user_id: str) -> Optional[int]:
+        """Return revocation epoch of user, None if user has no epoch"""
+        return (await self.get_many(redis, [user_id]))[str(user_id)]
+
+    async def get_many(self, redis: Redis, user_ids: Iterable[str]) -> dict[str, Optional[int]]:
+        """Return revocation epochs by user id (None for users without epoch), asking Redis with at most one MGET"""
+        epochs: dict[str, int] = {}
+        missing = []
+        for user_id in map(str, user_ids):
+            if user_id in epochs:
+                continue
+            if (epoch := self._get_local(user_id)) is None:
+                missing.append(user_id)
+            epochs[user_id] = epoch or 0
+        if missing:
+            for user_id, epoch in zip(missing, await redis.mget([epoch_key(user_id) for user_id in missing])):
+                epochs[user_id] = int(epoch or 0)
+                if self.ready:
+                    self._remember(user_id, epochs[user_id])
+        return {user_id: epoch or None for user_id, epoch in epochs.items()}
+
+    def on_message(self, data: str):
+        """Message is one `<user_id> <epoch> <expires_at>` triple per line"""
+        for line in data.splitlines():
+            user_id, epoch, expires_at = line.split(' ')
+            self.add(user_id, int(epoch), int(expires_at))
+
+    async def warm_up(self, redis: Redis):
+        self.ready = False
+        self._filter.clear()
+        self._epochs.clear()
+        batch = []
+        async for key in redis.scan_iter(match=f'{EPOCH_KEY_PREFIX}*', count=WARM_UP_BATCH_SIZE):
+            batch.append(key.decode() if isinstance(key, bytes) else key)
+            if len(batch) >= WARM_UP_BATCH_SIZE:
+                await self._load_batch(redis, batch)
+                batch = []
+        if batch:
+            await self._load_batch(redis, batch)
+        self.ready = True
+
+    async def _load_batch(self, redis: Redis, keys: list[str]):
+        now = time.time()
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get(key)
+                pipe.ttl(key)
+            values = await pipe.execute()
+        for key, epoch, ttl in zip(keys, values[::2], values[1::2]):
+            if epoch and ttl > 0:
+                self.add(key[len(EPOCH_KEY_PREFIX):], int(epoch), int(now + ttl) + 1)
+
+    def on_disconnect(self):
+        self.ready = False
+
+    def purge(self):
+        self._filter.purge()
+
+    def stats(self) -> dict:
+        return {
+            'ready': self.ready,
+            'size': len(self._filter),
+            'lookups': self.lookups,
+            'local_hits': self.local_hits,
+            'redis_lookups': self.redis_lookups,
+            'hit_rate': self.local_hits / self.lookups if self.lookups else 0.0,
+        }
+
+
+class FilterPurger:
+    """Drops expired generations from the revocation filters every BLACKLIST_PURGE_INTERVAL seconds, off the lookup path"""
+
+    def __init__(self, *caches):
+        self._caches = caches
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(SETTINGS.BLACKLIST.BLACKLIST_PURGE_INTERVAL)
+            for cache in self._caches:
+                cache.purge()
+
+
+revoked_tokens = RevokedTokensCache()
+broadcast.subscribe(SETTINGS.BLACKLIST.BLACKLIST_CHANNEL, on_message=revoked_tokens.on_message,
+                    on_connect=revoked_tokens.on_connect, on_disconnect=revoked_tokens.on_disconnect)
+
+revocation_epochs = RevocationEpochs()
+if SETTINGS.BLACKLIST.REVOCATION_EPOCH_ENABLED:
+    broadcast.subscribe(SETTINGS.BLACKLIST.REVOCATION_EPOCH_CHANNEL, on_message=revocation_epochs.on_message,
+                        on_connect=revocation_epochs.warm_up, on_disconnect=revocation_epochs.on_disconnect)
+
+filter_purger = FilterPurger(revoked_tokens, revocation_epochs)
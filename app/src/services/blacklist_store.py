@@ -0,0 +1,160 @@
+"""
+Storage of blacklisted jti keys, spread over REDIS_BLACKLIST_NODES with consistent hashing.
+Without nodes configured every key stays on the main Redis. Pub/sub and revocation epochs always use the main Redis.
+
+Adding or removing a node moves about 1/N of the keys to other nodes. Set REDIS_BLACKLIST_PREVIOUS_NODES to the
+old node list, so a key not found on its new owner is also looked up on its old one, then run
+`python manage.py rebalance-blacklist`, and set REDIS_BLACKLIST_PREVIOUS_NODES equal to REDIS_BLACKLIST_NODES
+once it has finished, which leaves nothing to look up twice.
+`main` in either list stands for the main Redis. An empty REDIS_BLACKLIST_PREVIOUS_NODES means ["main"], so the first
+move from a single Redis to nodes keeps reading the keys still there. The main Redis is always scanned by warm up
+and rebalance.
+"""
+import asyncio
+import bisect
+import hashlib
+from typing import AsyncIterator, Iterable, Optional
+
+from redis.asyncio import Redis
+
+from core.config import SETTINGS
+from db.redis_inj import InstrumentedConnectionPool, InstrumentedRedis
+
+UUID_KEY_PATTERN = '????????-????-????-????-????????????'
+SCAN_BATCH_SIZE = 1000
+MAIN_NODE = 'main'
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    def __init__(self, nodes: Iterable[str], vnodes: int):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash(f'{node}#{replica}'), node) for node in self.nodes for replica in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key: str) -> str:
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        return self._owners[bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+    def group(self, keys: list[str]) -> dict[str, list[int]]:
+        """Indexes of keys by owner node"""
+        groups: dict[str, list[int]] = {}
+        for index, key in enumerate(keys):
+            groups.setdefault(self.node_for(key), []).append(index)
+        return groups
+
+
+class BlacklistStore:
+    def __init__(self):
+        self._clients: dict[str, Redis] = {}
+        self._pools: list[InstrumentedConnectionPool] = []
+        self._ring: Optional[HashRing] = None
+        self._previous_ring: Optional[HashRing] = None
+
+    def configure(self, main: Redis):
+        """Connect to the configured nodes, `main` is used when there are none"""
+        settings = SETTINGS.REDIS
+        if not settings.REDIS_BLACKLIST_NODES:
+            self._clients = {MAIN_NODE: main}
+            self._ring, self._previous_ring = HashRing([MAIN_NODE], vnodes=1), None
+            return
+        self._clients[MAIN_NODE] = main
+        for url in {*settings.REDIS_BLACKLIST_NODES, *settings.REDIS_BLACKLIST_PREVIOUS_NODES} - {MAIN_NODE}:
+            pool = InstrumentedConnectionPool.from_url(url, max_connections=settings.REDIS_MAX_CONNECTIONS)
+            self._pools.append(pool)
+            self._clients[url] = InstrumentedRedis(connection_pool=pool)
+        self._ring = HashRing(settings.REDIS_BLACKLIST_NODES, vnodes=settings.REDIS_BLACKLIST_VNODES)
+        previous_nodes = settings.REDIS_BLACKLIST_PREVIOUS_NODES or [MAIN_NODE]
+        self._previous_ring = HashRing(previous_nodes, vnodes=settings.REDIS_BLACKLIST_VNODES) \
+            if set(previous_nodes) != set(settings.REDIS_BLACKLIST_NODES) else None
+
+    async def close(self):
+        for pool in self._pools:
+            await pool.disconnect()
+        self._pools, self._clients = [], {}
+        self._ring = self._previous_ring = None
+
+    async def add_many(self, entries: list[tuple[str, int]]):
+        """Write (jti, exp) pairs, one pipeline per node, nodes in parallel"""
+        jtis = [jti for jti, _ in entries]
+
+        async def write(node: str, indexes: list[int]):
+            async with self._clients[node].pipeline(transaction=False) as pipe:
+                for index in indexes:
+                    jti, exp = entries[index]
+                    pipe.set(name=jti, value='true', exat=exp)
+                await pipe.execute()
+
+        await asyncio.gather(*(write(node, indexes) for node, indexes in self._ring.group(jtis).items()))
+
+    async def _read(self, ring: HashRing, jtis: list[str], indexes: list[int], revoked: list[bool]):
+        async def read(node: str, node_indexes: list[int]):
+            answers = await self._clients[node].mget([jtis[indexes[index]] for index in node_indexes])
+            for index, answer in zip(node_indexes, answers):
+                revoked[indexes[index]] = bool(answer)
+
+        keys = [jtis[index] for index in indexes]
+        await asyncio.gather(*(read(node, node_indexes) for node, node_indexes in ring.group(keys).items()))
+
+    async def get_many(self, jtis: list[str]) -> list[bool]:
+        """Whether every jti is blacklisted, in order, with one MGET per node"""
+        revoked = [False] * len(jtis)
+        await self._read(self._ring, jtis, list(range(len(jtis))), revoked)
+        if self._previous_ring is not None:
+            moved = [index for index, jti in enumerate(jtis)
+                     if not revoked[index] and self._previous_ring.node_for(jti) != self._ring.node_for(jti)]
+            if moved:
+                await self._read(self._previous_ring, jtis, moved, revoked)
+        return revoked
+
+    async def is_revoked(self, jti: str) -> bool:
+        return (await self.get_many([jti]))[0]
+
+    async def _scan_ttls(self, client: Redis) -> AsyncIterator[list[tuple[str, int]]]:
+        batch = []
+        async for key in client.scan_iter(match=UUID_KEY_PATTERN, count=SCAN_BATCH_SIZE):
+            batch.append(key.decode() if isinstance(key, bytes) else key)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                yield await self._ttls(client, batch)
+                batch = []
+        if batch:
+            yield await self._ttls(client, batch)
+
+    @staticmethod
+    async def _ttls(client: Redis, keys: list[str]) -> list[tuple[str, int]]:
+        async with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.ttl(key)
+            return list(zip(keys, await pipe.execute()))
+
+    async def scan_ttls(self) -> AsyncIterator[list[tuple[str, int]]]:
+        """Batches of (jti, TTL in seconds) from every node"""
+        for client in self._clients.values():
+            async for batch in self._scan_ttls(client):
+                yield batch
+
+    async def rebalance(self) -> int:
+        """Move every key that is not on its owner in the current ring there, return number of moved keys"""
+        moved = 0
+        for node, client in self._clients.items():
+            async for batch in self._scan_ttls(client):
+                misplaced = [(key, ttl) for key, ttl in batch if ttl > 0 and self._ring.node_for(key) != node]
+                if not misplaced:
+                    continue
+                for owner, indexes in self._ring.group([key for key, _ in misplaced]).items():
+                    async with self._clients[owner].pipeline(transaction=False) as pipe:
+                        for index in indexes:
+                            key, ttl = misplaced[index]
+                            pipe.set(name=key, value='true', ex=ttl)
+                        await pipe.execute()
+                await client.delete(*(key for key, _ in misplaced))
+                moved += len(misplaced)
+        return moved
+
+
+blacklist_store = BlacklistStore()
@@ -0,0 +1,86 @@
+import hashlib
+import math
+import time
+from typing import Optional
+
+Positions = list[tuple[int, int]]
+
+
+class BloomFilter:
+    """Compact probabilistic set: `in` may give false positives, but never false negatives"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item: str) -> Positions:
+        """(byte, bit mask) pairs of item, the same for every filter of the same capacity and error rate"""
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(position >> 3, 1 << (position & 7))
+                for position in ((h1 + i * h2) % self.size for i in range(self.hash_count))]
+
+    def add(self, item: str):
+        self.add_positions(self.positions(item))
+
+    def add_positions(self, positions: Positions):
+        bits = self._bits
+        for byte, mask in positions:
+            bits[byte] |= mask
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return self.has_positions(self.positions(item))
+
+    def has_positions(self, positions: Positions) -> bool:
+        bits = self._bits
+        return all(bits[byte] & mask for byte, mask in positions)
+
+    @property
+    def is_full(self) -> bool:
+        return self.count >= self.capacity
+
+
+class ExpiringBloomFilter:
+    """
+    Bloom filter whose items expire within `lifetime` seconds. Items are grouped into `generations` buckets
+    by their expiration timestamp, `purge` drops a whole bucket once every item in it has expired.
+    Every bucket holds filters of the same size, so a lookup hashes the item once and tests those positions in each.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, lifetime: int, generations: int):
+        self.generation_seconds = max(1, math.ceil(lifetime / generations))
+        # up to generations + 1 buckets are alive at once, each of them adds to the false positive rate
+        self._capacity = max(1, capacity // generations)
+        self._error_rate = error_rate / (generations + 1)
+        self._probe = BloomFilter(capacity=self._capacity, error_rate=self._error_rate)
+        self._buckets: dict[int, list[BloomFilter]] = {}
+
+    def add(self, item: str, expires_at: int | float):
+        bucket_end = math.ceil(expires_at / self.generation_seconds) * self.generation_seconds
+        if bucket_end <= time.time():
+            return
+        filters = self._buckets.setdefault(bucket_end, [])
+        if not filters or filters[-1].is_full:
+            filters.append(BloomFilter(capacity=self._capacity, error_rate=self._error_rate))
+        filters[-1].add_positions(self._probe.positions(item))
+
+    def __contains__(self, item: str) -> bool:
+        """Expired buckets are only dropped by `purge`, until then they can add false positives but nothing else"""
+        positions = self._probe.positions(item)
+        return any(bloom.has_positions(positions) for filters in self._buckets.values() for bloom in filters)
+
+    def __len__(self) -> int:
+        return sum(bloom.count for filters in self._buckets.values() for bloom in filters)
+
+    def purge(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        for bucket_end in [bucket_end for bucket_end in self._buckets if bucket_end <= now]:
+            del self._buckets[bucket_end]
+
+    def clear(self):
+        self._buckets.clear()
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Callable, Awaitable, Optional
+
+from redis.asyncio.client import Redis
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY_SECONDS = 1
+
+
+@dataclass
+class Subscription:
+    on_message: Callable[[str], None]
+    on_connect: Optional[Callable[[Redis], Awaitable[None]]] = None
+    on_disconnect: Optional[Callable[[], None]] = None
+
+
+class Broadcast:
+    """
+    Redis pub/sub listener shared by per-worker caches.
+    Every (re)connect calls `on_connect` of subscribers so they can resync their state,
+    while disconnected subscribers get `on_disconnect` and must not trust their local state.
+    """
+
+    def __init__(self):
+        self._subscriptions: dict[str, list[Subscription]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.connected = False
+
+    def subscribe(self, channel: str, on_message: Callable[[str], None],
+                  on_connect: Callable[[Redis], Awaitable[None]] = None, on_disconnect: Callable[[], None] = None):
+        self._subscriptions.setdefault(channel, []).append(
+            Subscription(on_message=on_message, on_connect=on_connect, on_disconnect=on_disconnect)
+        )
+
+    def start(self, redis: Redis):
+        if self._task is None and self._subscriptions:
+            self._task = asyncio.create_task(self._listen(redis))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _all_subscriptions(self):
+        return (subscription for subscriptions in self._subscriptions.values() for subscription in subscriptions)
+
+    async def _listen(self, redis: Redis):
+        while True:
+            pubsub = redis.pubsub()
+            try:
+                await pubsub.subscribe(*self._subscriptions)
+                for subscription in self._all_subscriptions():
+                    if subscription.on_connect:
+                        await subscription.on_connect(redis)
+                self.connected = True
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    channel, data = message['channel'], message['data']
+                    channel = channel.decode() if isinstance(channel, bytes) else channel
+                    data = data.decode() if isinstance(data, bytes) else data
+                    for subscription in self._subscriptions.get(channel, ()):
+                        subscription.on_message(data)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Broadcast listener lost connection to Redis, reconnecting')
+            finally:
+                self.connected = False
+                for subscription in self._all_subscriptions():
+                    if subscription.on_disconnect:
+                        subscription.on_disconnect()
+                await pubsub.reset()
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+
+broadcast = Broadcast()
@@ -1,6 +1,6 @@
 import uuid
 
-from sqlalchemy import select, ClauseElement
+from sqlalchemy import select, update, delete, ClauseElement, ColumnElement, Executable
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -11,6 +11,13 @@ async def read_instance(db: AsyncSession, model, condition: ClauseElement):
     instance = instance.scalar()
     return instance if instance else None
 
+
+async def read_instance_by_statement(db: AsyncSession, statement: Executable):
+    """Get an object with a prebuilt (usually lambda_stmt cached) statement, return None if it does not exist"""
+    instance = await db.execute(statement)
+    return instance.scalar()
+
+
 async def read_batch_instance(db: AsyncSession, model, condition: ClauseElement):
     """Get list an objects by condition, return None if objects with provided condition does not exist"""
     instance = await db.execute(select(model).where(condition))
@@ -18,31 +25,57 @@ async def read_batch_instance(db: AsyncSession, model, condition: ClauseElement)
     return list_instances if len(list_instances) else None
 
 
+async def update_where(db: AsyncSession, model, condition: ClauseElement, values: dict) -> list:
+    """Update objects matching condition with one UPDATE ... RETURNING statement, return updated objects"""
+    result = await db.execute(
+        update(model).where(condition).values(**values).returning(model)
+        .execution_options(synchronize_session=False)
+    )
+    instances = result.scalars().all()
+    await db.commit()
+    return instances
+
+
+async def delete_where(db: AsyncSession, model, condition: ClauseElement,
+                       returning: ColumnElement | tuple[ColumnElement, ...] = None, commit: bool = True) -> list:
+    """Delete objects matching condition with one DELETE ... RETURNING statement,
+    return values of `returning` column (id by default) of deleted rows, or rows if several columns are given.
+    With commit=False the caller commits, e.g. after side effects that must succeed first"""
+    columns = returning if isinstance(returning, tuple) else (returning if returning is not None else model.id,)
+    result = await db.execute(
+        delete(model).where(condition).returning(*columns)
+        .execution_options(synchronize_session=False)
+    )
+    deleted = result.all() if len(columns) > 1 else result.scalars().all()
+    if commit:
+        await db.commit()
+    return deleted
+
+
+async def bulk_update(db: AsyncSession, model, rows: list[dict]):
+    """Update many objects by primary key with one executemany UPDATE, every row must contain `id`"""
+    if rows:
+        await db.execute(update(model), rows)
+        await db.commit()
+
+
 async def update_instance(db: AsyncSession, model, instance_id: uuid.UUID, data_dict: dict):
     """Update an object, raise exception if the object with instance_id doesn't exist"""
-    result = await db.execute(select(model).where(model.id == instance_id))
-    instance = result.scalars().first()
-
-    if instance:
-        for key, value in data_dict.items():
-            if value is not None:
-                setattr(instance, key, value)
-            await db.commit()
-        await db.refresh(instance)
-        return instance
+    values = {key: value for key, value in data_dict.items() if value is not None}
+    if values:
+        instances = await update_where(db=db, model=model, condition=model.id == instance_id, values=values)
+    else:
+        instances = [instance] if (instance := await read_instance(db, model, model.id == instance_id)) else []
+
+    if instances:
+        return instances[0]
     else:
         raise NoResultFound('Object with provided id does not exist')
 
 
 async def delete_instance(db: AsyncSession, model, instance_id: uuid.UUID) -> str:
     """Delete an object, raise exception if the object with instance_id doesn't exist"""
-    result = await db.execute(select(model).where(model.id == instance_id))
-    instance = result.scalars().first()
-
-    if instance is None:
+    if not await delete_where(db=db, model=model, condition=model.id == instance_id):
         raise NoResultFound(f"No {model.__name__} found with id {instance_id}")
 
-    await db.delete(instance)
-    await db.commit()
-
     return f"{model.__name__} with id {instance_id} deleted successfully"
@@ -1,35 +1,100 @@
+"""
+With SESSION_STORE=redis sessions are rotated and deleted in Redis (services.session_store) and reach this table
+through the write-behind worker, so upsert_token, delete_token_by_ua_uid and delete_tokens_by_user_id go to Redis,
+while the other functions read and write the table directly.
+"""
 from __future__ import annotations
 
 import datetime
 import uuid
+from typing import AsyncIterator
 
+from sqlalchemy import select, lambda_stmt, func, tuple_, delete, text, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import NoResultFound
 
+from core.config import SETTINGS
+from db.redis_inj import get_redis
 from models.models import RefreshTokens as RefreshTokensModel
-from services.crud.base import update_instance, read_instance, delete_instance, read_batch_instance
+from services.crud.base import read_instance, read_instance_by_statement, read_batch_instance, update_where, \
+    delete_where
+from services.session_store import StoredToken, TokenReuseDetected, session_store
+from services.useragent import ua_fingerprint
 
 
-async def create_token(db: AsyncSession, refresh_token: str, useragent: str, user_id: uuid.UUID) -> RefreshTokensModel:
-    """Create row with refresh token"""
-    db_token = RefreshTokensModel(user_id=user_id, refresh_token=refresh_token,
-                                  useragent=useragent)
+def _redis_sessions() -> bool:
+    return SETTINGS.SESSIONS.SESSION_STORE == 'redis'
+
+
+def _issued_at(table):
+    return func.coalesce(table.c.updated_at, table.c.created_at)
+
+
+async def create_token(db: AsyncSession, jti: uuid.UUID, useragent: str, user_id: uuid.UUID) -> RefreshTokensModel:
+    """Create row with refresh token jti"""
+    db_token = RefreshTokensModel(user_id=user_id, jti=jti, useragent=useragent,
+                                  ua_fingerprint=ua_fingerprint(useragent))
     db_token.id = uuid.uuid4()
     db.add(db_token)
-    await db.flush()
     await db.commit()
     return db_token
 
 
-async def get_token_by_token(db: AsyncSession, refresh_token: str) -> RefreshTokensModel | None:
-    """Get token by refresh_token, return None if token does not exist"""
-    return await read_instance(db=db, model=RefreshTokensModel,
-                               condition=RefreshTokensModel.refresh_token == refresh_token)
+async def upsert_token(db: AsyncSession, jti: uuid.UUID, useragent: str, user_id: uuid.UUID,
+                       expected_jti: str | None = None) -> StoredToken | None:
+    """
+    Create refresh session for user and user agent or replace its token.
+    An existing session is rotated by one UPDATE that locks the row in a subquery and returns the replaced token
+    to be blacklisted; a new one is inserted. Only a login racing another login of the same session needs a retry
+    :param jti: jti of the new refresh token
+    :param expected_jti: jti of the presented refresh token on /reroll. If the session does not hold it
+        (it was already rotated, so the presented token is reused), the session is deleted and
+        TokenReuseDetected carries the current token to blacklist. With SESSION_STORE=redis a missing session
+        raises SessionsNotRecovered instead while sessions are not yet reloaded after Redis lost its data
+    :return: previous refresh token of this session, None if session is new
+    """
+    if _redis_sessions():
+        return await session_store.upsert(await get_redis(), jti=jti, useragent=useragent, user_id=user_id,
+                                          expected_jti=expected_jti)
+    table = RefreshTokensModel.__table__
+    fingerprint = ua_fingerprint(useragent)
+    now = datetime.datetime.utcnow()
+    session = (table.c.user_id == user_id) & (table.c.ua_fingerprint == fingerprint)
+    old = select(table.c.id, table.c.jti, _issued_at(table).label('issued_at')) \
+        .where(session).with_for_update().subquery('old')
+    rotated = table.c.id == old.c.id
+    if expected_jti is not None:
+        rotated &= old.c.jti == expected_jti
+    rotate = update(table).where(rotated).values(jti=jti, updated_at=now).returning(old.c.jti, old.c.issued_at)
+    while True:
+        if previous := (await db.execute(rotate)).one_or_none():
+            await db.commit()
+            return StoredToken(*previous)
+        if expected_jti is not None:
+            current = (await db.execute(delete(table).where(session).returning(*_stored_token_columns()))).one_or_none()
+            await db.commit()
+            raise TokenReuseDetected(StoredToken(*current) if current else None)
+        inserted = await db.execute(insert(table).values(
+            id=uuid.uuid4(), user_id=user_id, useragent=useragent, ua_fingerprint=fingerprint, jti=jti, created_at=now
+        ).on_conflict_do_nothing(constraint='ua_fingerprint_user_uniq_constr').returning(table.c.id))
+        if inserted.scalar() is not None:
+            await db.commit()
+            return None
+        # a concurrent login created the session after the UPDATE found none, rotate it instead
+
+
+async def get_token_by_jti(db: AsyncSession, jti: uuid.UUID) -> RefreshTokensModel | None:
+    """Get token by refresh token jti, return None if token does not exist"""
+    return await read_instance(db=db, model=RefreshTokensModel, condition=RefreshTokensModel.jti == jti)
 
 
 async def get_token_by_ua_uid(db: AsyncSession, useragent: str, user_id: uuid.UUID) -> RefreshTokensModel:
-    return await read_instance(db=db, model=RefreshTokensModel,
-                               condition=RefreshTokensModel.useragent == useragent and RefreshTokensModel.user_id == user_id)
+    fingerprint = ua_fingerprint(useragent)
+    return await read_instance_by_statement(db=db, statement=lambda_stmt(
+        lambda: select(RefreshTokensModel).where(RefreshTokensModel.user_id == user_id,
+                                                 RefreshTokensModel.ua_fingerprint == fingerprint)
+    ))
 
 
 async def get_tokens_by_user_id(db: AsyncSession, refresh_token: dict) -> list[RefreshTokensModel] | None:
@@ -41,29 +106,113 @@ async def get_tokens_by_user_id(db: AsyncSession, refresh_token: dict) -> list[R
                                      condition=RefreshTokensModel.user_id == refresh_token['sub'])
 
 
-async def update_token_by_ua_uid(db: AsyncSession, new_token: str, user_id: uuid.UUID, useragent) -> RefreshTokensModel:
-    instance = await read_instance(db=db, model=RefreshTokensModel,
-                                   condition=RefreshTokensModel.user_id == user_id and RefreshTokensModel.useragent == useragent)
-    if not instance:
-        raise NoResultFound
-
-    return await update_instance(
-        db=db, model=RefreshTokensModel, instance_id=instance.id, data_dict={
-            "user_id": user_id,
-            "useragent": useragent,
+async def update_token_by_ua_uid(db: AsyncSession, new_jti: uuid.UUID, user_id: uuid.UUID, useragent) -> RefreshTokensModel:
+    instances = await update_where(
+        db=db, model=RefreshTokensModel,
+        condition=(RefreshTokensModel.user_id == user_id) &
+                  (RefreshTokensModel.ua_fingerprint == ua_fingerprint(useragent)),
+        values={
             "updated_at": datetime.datetime.utcnow(),
-            "refresh_token": new_token
+            "jti": new_jti
         }
     )
+    if not instances:
+        raise NoResultFound
+
+    return instances[0]
 
 
-async def delete_token(db: AsyncSession, refresh_token: str):
+async def delete_token(db: AsyncSession, jti: uuid.UUID):
     """
 
     :param db:
-    :param refresh_token: encoded JWT
+    :param jti: jti of refresh token
     :return:
     """
-    instance = await read_instance(db=db, model=RefreshTokensModel,
-                                   condition=RefreshTokensModel.refresh_token == refresh_token)
-    return await delete_instance(db=db, model=RefreshTokensModel, instance_id=instance.id)
+    if not await delete_where(db=db, model=RefreshTokensModel, condition=RefreshTokensModel.jti == jti):
+        raise NoResultFound
+
+
+def _stored_token_columns():
+    table = RefreshTokensModel.__table__
+    return table.c.jti, _issued_at(table)
+
+
+async def delete_token_by_ua_uid(db: AsyncSession, useragent: str, user_id: uuid.UUID) -> StoredToken | None:
+    """Delete refresh session of user and user agent
+    :return: deleted refresh token, None if session does not exist
+    """
+    if _redis_sessions():
+        return await session_store.delete(await get_redis(), useragent=useragent, user_id=user_id)
+    deleted = await delete_where(db=db, model=RefreshTokensModel,
+                                 condition=(RefreshTokensModel.ua_fingerprint == ua_fingerprint(useragent)) &
+                                           (RefreshTokensModel.user_id == user_id),
+                                 returning=_stored_token_columns())
+    return StoredToken(*deleted[0]) if deleted else None
+
+
+async def delete_tokens_by_user_id(db: AsyncSession, user_id: uuid.UUID, commit: bool = True) -> list[StoredToken]:
+    """Delete every refresh session of user in one statement
+    :param commit: with False the caller commits, e.g. only after deleted tokens are blacklisted
+    :return: deleted refresh tokens
+    """
+    if _redis_sessions():
+        return await session_store.delete_all(await get_redis(), user_id=user_id)
+    deleted = await delete_where(db=db, model=RefreshTokensModel, condition=RefreshTokensModel.user_id == user_id,
+                                 returning=_stored_token_columns(), commit=commit)
+    return [StoredToken(*row) for row in deleted]
+
+
+async def delete_expired_tokens(db: AsyncSession, batch_size: int, lock_timeout_ms: int) -> int:
+    """Delete up to batch_size sessions whose refresh token has expired, in one short transaction.
+    Rows locked by concurrent logins are skipped, waiting for any other lock is capped by lock_timeout_ms
+    :return: number of deleted sessions
+    """
+    table = RefreshTokensModel.__table__
+    expired_before = datetime.datetime.now(datetime.timezone.utc) - \
+        datetime.timedelta(minutes=SETTINGS.JWT.REFRESH_TOKEN_EXPIRE_MINUTES)
+    expired = select(table.c.id).where(_issued_at(table) < expired_before) \
+        .limit(batch_size).with_for_update(skip_locked=True)
+    await db.execute(text(f'SET LOCAL lock_timeout = {int(lock_timeout_ms)}'))
+    return len(await delete_where(db=db, model=RefreshTokensModel, condition=RefreshTokensModel.id.in_(expired)))
+
+
+async def apply_session_changes(db: AsyncSession, upserts: list[dict], deleted: list[tuple[uuid.UUID, bytes]],
+                                deleted_users: list[uuid.UUID]):
+    """Persist a batch of session changes made in Redis, in one transaction.
+    Changes must be coalesced to the last one per session, deletions of all user sessions apply first.
+    An upsert never overwrites a session that got a newer token, so replaying a batch is harmless.
+    :param upserts: dicts of user_id, useragent, ua_fingerprint, jti and issued_at
+    :param deleted: (user_id, ua_fingerprint) of deleted sessions
+    :param deleted_users: ids of users whose sessions were all deleted
+    """
+    table = RefreshTokensModel.__table__
+    if deleted_users:
+        await db.execute(delete(table).where(table.c.user_id.in_(deleted_users)))
+    if deleted:
+        await db.execute(delete(table).where(tuple_(table.c.user_id, table.c.ua_fingerprint).in_(deleted)))
+    if upserts:
+        stmt = insert(table).values([
+            {'id': uuid.uuid4(), 'user_id': change['user_id'], 'useragent': change['useragent'],
+             'ua_fingerprint': change['ua_fingerprint'], 'jti': change['jti'], 'created_at': change['issued_at']}
+            for change in upserts
+        ])
+        await db.execute(stmt.on_conflict_do_update(
+            constraint='ua_fingerprint_user_uniq_constr',
+            set_={'jti': stmt.excluded.jti, 'updated_at': stmt.excluded.created_at},
+            where=_issued_at(table) <= stmt.excluded.created_at
+        ))
+    await db.commit()
+
+
+async def stream_active_sessions(db: AsyncSession, batch_size: int) -> AsyncIterator[tuple]:
+    """Yield (user_id, ua_fingerprint, jti, issued_at) of sessions whose refresh token has not expired yet"""
+    table = RefreshTokensModel.__table__
+    issued_since = datetime.datetime.utcnow() - datetime.timedelta(minutes=SETTINGS.JWT.REFRESH_TOKEN_EXPIRE_MINUTES)
+    rows = await db.stream(
+        select(table.c.user_id, table.c.ua_fingerprint, table.c.jti, _issued_at(table))
+        .where(_issued_at(table) > issued_since)
+        .execution_options(yield_per=batch_size)
+    )
+    async for row in rows:
+        yield tuple(row)
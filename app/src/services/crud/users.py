@@ -1,10 +1,13 @@
 import uuid
 
+from sqlalchemy import or_, select, lambda_stmt
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.exc import NoResultFound
 
 from models.models import Users as UserModel
 from models.schemas.auth import User, UserCreate, UserUpdate
-from services.crud.base import update_instance, read_instance, delete_instance
+from services.crud.base import read_instance, read_instance_by_statement, update_where, delete_where
+from services.user_cache import user_cache, CachedUser
 
 
 async def create_user(db: AsyncSession, user: User | UserCreate) -> UserModel:
@@ -12,31 +15,82 @@ async def create_user(db: AsyncSession, user: User | UserCreate) -> UserModel:
     db_user = UserModel(**user.dict())
     db_user.id = uuid.uuid4()
     db.add(db_user)
-    await db.flush()
     await db.commit()
     return db_user
 
 
 async def get_user_by_id(db: AsyncSession, user_id: uuid.UUID) -> UserModel | None:
     """Get user by id, return None if user with provided id does not exist"""
-    return await read_instance(db=db, model=UserModel, condition=UserModel.id == user_id)
+    return await read_instance_by_statement(
+        db=db, statement=lambda_stmt(lambda: select(UserModel).where(UserModel.id == user_id))
+    )
 
 
 async def get_user_by_username(db: AsyncSession, username: str) -> UserModel | None:
     """Get user by unique username, return None if user with provided username does not exist"""
-    return await read_instance(db=db, model=UserModel, condition=UserModel.username == username)
+    return await read_instance_by_statement(
+        db=db, statement=lambda_stmt(lambda: select(UserModel).where(UserModel.username == username))
+    )
 
 
 async def get_user_by_email(db: AsyncSession, email: str) -> UserModel | None:
     """Get user by email, return None if user with provided email does not exist"""
-    return await read_instance(db=db, model=UserModel, condition=UserModel.email == email)
+    return await read_instance_by_statement(
+        db=db, statement=lambda_stmt(lambda: select(UserModel).where(UserModel.email == email))
+    )
+
+
+async def get_cached_user_by_id(db: AsyncSession, user_id: uuid.UUID) -> CachedUser | None:
+    """Get compact user record by id through the user cache, return None if user does not exist"""
+    if cached := await user_cache.get_by_id(user_id):
+        return cached
+    if user := await get_user_by_id(db=db, user_id=user_id):
+        return await user_cache.put(user)
+    return None
+
+
+async def get_cached_user_by_email(db: AsyncSession, email: str) -> CachedUser | None:
+    """Get compact user record by email through the user cache, return None if user does not exist"""
+    if cached := await user_cache.get_by_email(email):
+        return cached
+    if user := await get_user_by_email(db=db, email=email):
+        return await user_cache.put(user)
+    return None
+
+
+async def get_user_by_email_or_username(db: AsyncSession, email: str, username: str) -> UserModel | None:
+    """Get any user with provided email or username, return None if both are free"""
+    return await read_instance(db=db, model=UserModel,
+                               condition=or_(UserModel.email == email, UserModel.username == username))
 
 
 async def update_user(db: AsyncSession, user_info: UserUpdate) -> UserModel:
-    """Update user with provided data"""
-    return await update_instance(db=db, model=UserModel, instance_id=user_info.id, data_dict=user_info.dict())
+    """Update user with provided data, raise exception if user with provided id does not exist"""
+    if not (values := user_info.dict(exclude_none=True, exclude={'id'})):
+        if not (user := await get_user_by_id(db=db, user_id=user_info.id)):
+            raise NoResultFound(f"No user found with id {user_info.id}")
+        return user
+    users = await update_where(db=db, model=UserModel, condition=UserModel.id == user_info.id, values=values)
+    if not users:
+        raise NoResultFound(f"No user found with id {user_info.id}")
+    await user_cache.invalidate(user_info.id, users[0].email)
+    return users[0]
+
+
+async def update_password_hash(db: AsyncSession, user_id: uuid.UUID, old_hash: str, new_hash: str) -> bool:
+    """Replace password hash of user unless it was changed meanwhile, return False in that case"""
+    users = await update_where(db=db, model=UserModel,
+                               condition=(UserModel.id == user_id) & (UserModel.password_hash == old_hash),
+                               values={'password_hash': new_hash})
+    if users:
+        await user_cache.invalidate(user_id, users[0].email)
+    return bool(users)
 
 
 async def delete_user(db: AsyncSession, user_id: uuid.UUID):
-    """Delete user with provided id"""
-    return await delete_instance(db=db, model=UserModel, instance_id=user_id)
+    """Delete user with provided id, raise exception if user with provided id does not exist"""
+    if not (emails := await delete_where(db=db, model=UserModel, condition=UserModel.id == user_id,
+                                         returning=UserModel.email)):
+        raise NoResultFound(f"No user found with id {user_id}")
+    await user_cache.invalidate(user_id, *emails)
+    return f"User with id {user_id} deleted successfully"
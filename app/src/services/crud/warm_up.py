@@ -0,0 +1,20 @@
+import asyncio
+import uuid
+
+from db.database import async_session
+from services.crud.refresh_tokens import get_token_by_ua_uid
+from services.crud.users import get_user_by_email, get_user_by_id, get_user_by_username
+
+
+async def _prepare_hot_lookups():
+    async with async_session() as db:
+        await get_user_by_email(db=db, email='')
+        await get_user_by_username(db=db, username='')
+        await get_user_by_id(db=db, user_id=uuid.UUID(int=0))
+        await get_token_by_ua_uid(db=db, useragent='', user_id=uuid.UUID(int=0))
+
+
+async def warm_up_statements(connections: int):
+    """Open `connections` pooled connections at once and run every hot lookup on each,
+    so compiled statements and asyncpg prepared statements are cached before the first request"""
+    await asyncio.gather(*(_prepare_hot_lookups() for _ in range(connections)))
@@ -1,17 +1,24 @@
+import calendar
 import enum
+import time
 import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
 from functools import wraps
-from datetime import datetime, timedelta
-from typing import Union, Any
+from datetime import datetime
+from types import MappingProxyType
+from itertools import islice
+from typing import Union, Any, Mapping, Optional, Iterable
 from http import HTTPStatus
 
-from jose import jwt
-from jose.exceptions import JWTError, ExpiredSignatureError, JWTClaimsError
 from redis.asyncio.client import Redis
 from fastapi import Request, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from core.config import SETTINGS
+from services.blacklist import revoked_tokens, revocation_epochs, epoch_key
+from services.blacklist_store import blacklist_store
+from services.jwt_codec import jwt_codec, InvalidToken
 
 
 class TokenType(enum.Enum):
@@ -19,32 +26,91 @@ class TokenType(enum.Enum):
     refresh = 'refresh'
 
 
+@dataclass(frozen=True)
+class VerifiedToken:
+    """Encoded JWT together with its verified claims, decoded once and passed around instead of the raw token"""
+    token: str
+    claims: Mapping[str, Any]
+
+    @property
+    def jti(self) -> str:
+        return self.claims['jti']
+
+    @property
+    def sub(self) -> str:
+        return self.claims['sub']
+
+    @property
+    def exp(self) -> int:
+        return self.claims['exp']
+
+
+@dataclass(frozen=True)
+class TokenId:
+    """Identity of a token that is no longer at hand encoded, enough to blacklist it"""
+    jti: str
+    exp: int
+
+
+def refresh_token_id(jti: Union[uuid.UUID, str], issued_at: datetime) -> TokenId:
+    """Identity of a stored refresh token, its expiration is derived from the time the session got it"""
+    exp = calendar.timegm(issued_at.utctimetuple()) + 60 * SETTINGS.JWT.REFRESH_TOKEN_EXPIRE_MINUTES
+    return TokenId(jti=str(jti), exp=exp)
+
+
+class ClaimsCache:
+    """LRU of already verified tokens, an entry is dropped as soon as its token expires"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, Mapping[str, Any]] = OrderedDict()
+
+    def get(self, token: str) -> Optional[Mapping[str, Any]]:
+        claims = self._entries.get(token)
+        if claims is None:
+            return None
+        if claims['exp'] <= time.time():
+            del self._entries[token]
+            return None
+        self._entries.move_to_end(token)
+        return claims
+
+    def put(self, token: str, claims: Mapping[str, Any]):
+        self._entries[token] = claims
+        self._entries.move_to_end(token)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+claims_cache = ClaimsCache(maxsize=SETTINGS.JWT.JWT_CLAIMS_CACHE_SIZE)
+
+
 def _create_token():
     def wrapper(fn):
         @wraps(fn)
         def decorator(*args, **kwargs):
             exp_delta = kwargs.get('expires_delta', None)
             token_type = TokenType.access.value if fn.__name__ == 'create_access_token' else TokenType.refresh.value
-            if exp_delta:
-                exp_delta = datetime.utcnow() + timedelta(minutes=exp_delta)
-            else:
-                exp_delta = datetime.utcnow() + timedelta(
-                    minutes=SETTINGS.JWT.ACCESS_TOKEN_EXPIRE_MINUTES
+            if not exp_delta:
+                exp_delta = SETTINGS.JWT.ACCESS_TOKEN_EXPIRE_MINUTES \
                     if token_type == TokenType.access.value else SETTINGS.JWT.REFRESH_TOKEN_EXPIRE_MINUTES
-                )
+            now = int(time.time())
             to_encode = {
-                "exp": exp_delta,
+                "exp": now + int(exp_delta * 60),
                 "sub": str(kwargs['subject']),
                 "iss": SETTINGS.PROJECT.PROJECT_NAME,
-                "nbf": datetime.utcnow(),
+                "nbf": now,
                 "jti": str(uuid.uuid4()),
-                "iat": datetime.utcnow(),
+                "iat": now,
                 "token_type": token_type,
                 "useragent": str(kwargs['useragent'])
             }
-            encoded_jwt = jwt.encode(
-                to_encode, SETTINGS.JWT.SECRET_KEY, SETTINGS.JWT.ALGORITHM
-            )
+            encoded_jwt = jwt_codec.encode(to_encode)
+            # issued tokens are read back right away (e.g. jti of refresh token to store the session)
+            claims_cache.put(encoded_jwt, MappingProxyType(to_encode))
             kwargs.update({
                 '_encoded_jwt': encoded_jwt
             })
@@ -79,52 +145,144 @@ def create_refresh_token(subject: Union[str, Any], useragent: str, expires_delta
     return _encoded_jwt
 
 
-async def blacklisting(redis: Redis, token: str):
+def verify_token(token: Union[str, VerifiedToken]) -> Optional[VerifiedToken]:
+    """Verify encoded JWT, return None if token is invalid or expired"""
+    if isinstance(token, VerifiedToken):
+        return token
+    if claims := JWTBearer.verify_jwt(token):
+        return VerifiedToken(token=token, claims=claims)
+    return None
+
+
+async def blacklisting(redis: Redis, token: Union[str, VerifiedToken, TokenId]):
     """
-    Write token to blacklist (Redis)
+    Write token to blacklist (Redis) and notify other workers
     :param redis:
-    :param token: encoded JWT
+    :param token: encoded JWT, already verified token or identity of token
     :return:
     """
-    if token := JWTBearer.verify_jwt(token):
-        await redis.set(
-            name=token['jti'],
-            value='true',
-            exat=token['exp']
-        )
-
-
-async def check_blacklist(redis: Redis, token_or_jti: Union[uuid.UUID, str]) -> bool:
-    if isinstance(token_or_jti, str):
-        if token := JWTBearer.verify_jwt(token_or_jti):
-            bltoken = await redis.get(name=token['jti'])
-            return True if bltoken else False
+    await blacklisting_many(redis=redis, tokens=[token])
+
+
+def _blacklist_entry(token: Union[str, VerifiedToken, TokenId]) -> Optional[Union[VerifiedToken, TokenId]]:
+    if isinstance(token, TokenId):
+        return token if token.exp > time.time() else None
+    return verify_token(token)
+
+
+async def blacklisting_many(redis: Redis, tokens: Iterable[Union[str, VerifiedToken, TokenId]]):
+    """
+    Write tokens to blacklist (blacklist_store) BLACKLIST_PIPELINE_SIZE tokens at a time, one pipeline per node,
+    notify other workers with one message per batch. Invalid and expired tokens are skipped.
+    :param redis:
+    :param tokens: encoded JWTs, already verified tokens or identities of tokens
+    :return:
+    """
+    verified = (token for token in map(_blacklist_entry, tokens) if token)
+    while batch := list(islice(verified, SETTINGS.BLACKLIST.BLACKLIST_PIPELINE_SIZE)):
+        for token in batch:
+            revoked_tokens.add(jti=token.jti, exp=token.exp)
+        await blacklist_store.add_many([(token.jti, token.exp) for token in batch])
+        await redis.publish(SETTINGS.BLACKLIST.BLACKLIST_CHANNEL, '\n'.join(f"{token.jti} {token.exp}" for token in batch))
+
+
+async def revoke_all_tokens(redis: Redis, user_id: str):
+    """
+    Revoke every token of user issued up to now by moving user's revocation epoch.
+    Epoch is rounded up to the next second because `iat` has second precision, so every token issued during
+    the current second is revoked as well, including one from a login that follows the logout-all within that second.
+    """
+    epoch = int(time.time()) + 1
+    expires_at = epoch + 60 * max(SETTINGS.JWT.ACCESS_TOKEN_EXPIRE_MINUTES, SETTINGS.JWT.REFRESH_TOKEN_EXPIRE_MINUTES)
+    revocation_epochs.add(user_id=user_id, epoch=epoch, expires_at=expires_at)
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.set(name=epoch_key(user_id), value=epoch, exat=expires_at)
+        pipe.publish(SETTINGS.BLACKLIST.REVOCATION_EPOCH_CHANNEL, f"{user_id} {epoch} {expires_at}")
+        await pipe.execute()
+
+
+async def _is_revoked_by_epoch(redis: Redis, token: VerifiedToken) -> bool:
+    if not SETTINGS.BLACKLIST.REVOCATION_EPOCH_ENABLED:
+        return False
+    epoch = await revocation_epochs.get(redis, token.sub)
+    return epoch is not None and token.claims['iat'] < epoch
+
+
+async def _is_revoked(redis: Redis, jti: str) -> bool:
+    if not revoked_tokens.might_be_revoked(jti):
+        return False
+    revoked = await blacklist_store.is_revoked(jti)
+    revoked_tokens.record_redis_answer(revoked)
+    return revoked
+
+
+def _verify_for_introspection(token: str) -> Optional[VerifiedToken]:
+    """Like verify_token, but a miss does not go to the claims cache, so large batches do not evict hot tokens"""
+    if claims := claims_cache.get(token):
+        return VerifiedToken(token=token, claims=claims)
+    try:
+        return VerifiedToken(token=token, claims=MappingProxyType(jwt_codec.decode(token)))
+    except InvalidToken:
+        return None
+
+
+async def introspect(redis: Redis, tokens: list[str]) -> list[Optional[VerifiedToken]]:
+    """
+    Verify tokens and check them against the blacklist with one MGET per node for every INTROSPECT_CHUNK_SIZE tokens,
+    only for jti the Bloom filter can not rule out, and one MGET for epochs of users the epoch cache does not know.
+    :return: verified token or None (invalid, expired or revoked) for every token, in order
+    """
+    results = []
+    chunk_size = SETTINGS.JWT.INTROSPECT_CHUNK_SIZE
+    for start in range(0, len(tokens), chunk_size):
+        verified = [_verify_for_introspection(token) for token in tokens[start:start + chunk_size]]
+        candidates = [index for index, token in enumerate(verified)
+                      if token and revoked_tokens.might_be_revoked(token.jti)]
+        if candidates:
+            answers = await blacklist_store.get_many([verified[index].jti for index in candidates])
+            for index, answer in zip(candidates, answers):
+                revoked_tokens.record_redis_answer(answer)
+                if answer:
+                    verified[index] = None
+        if SETTINGS.BLACKLIST.REVOCATION_EPOCH_ENABLED:
+            epochs = await revocation_epochs.get_many(redis, [token.sub for token in verified if token])
+            for index, token in enumerate(verified):
+                if token and (epoch := epochs[str(token.sub)]) is not None and token.claims['iat'] < epoch:
+                    verified[index] = None
+        results.extend(verified)
+    return results
+
+
+async def check_blacklist(redis: Redis, token_or_jti: Union[VerifiedToken, uuid.UUID, str]) -> bool:
+    if isinstance(token_or_jti, (str, VerifiedToken)):
+        if token := verify_token(token_or_jti):
+            return await _is_revoked_by_epoch(redis, token) or await _is_revoked(redis, token.jti)
     elif isinstance(token_or_jti, uuid.UUID):
-        bltoken = await redis.get(name=token_or_jti)
-        return True if bltoken else False
+        return await _is_revoked(redis, str(token_or_jti))
 
 
 class JWTBearer(HTTPBearer):
     def __init__(self, auto_error: bool = True):
         super(JWTBearer, self).__init__(auto_error=auto_error)
 
-    async def __call__(self, request: Request):
+    async def __call__(self, request: Request) -> VerifiedToken:
         credentials: HTTPAuthorizationCredentials = await super(JWTBearer, self).__call__(request)
         if credentials:
             if not credentials.scheme == "Bearer":
                 raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Invalid authentication scheme.")
-            if not self.verify_jwt(jwtoken=credentials.credentials):
+            if not (token := verify_token(credentials.credentials)):
                 raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Invalid token or expired token.")
-            return credentials.credentials
+            return token
         else:
             raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Invalid authorization code.")
 
     @staticmethod
-    def verify_jwt(jwtoken: str) -> Union[bool, dict]:
+    def verify_jwt(jwtoken: str) -> Union[bool, Mapping[str, Any]]:
+        if payload := claims_cache.get(jwtoken):
+            return payload
         try:
-            payload = jwt.decode(jwtoken,
-                                 key=SETTINGS.JWT.SECRET_KEY,
-                                 algorithms=SETTINGS.JWT.ALGORITHM)
-        except (JWTError, JWTClaimsError, ExpiredSignatureError):
-            payload = None
-        return payload if payload else False
+            payload = MappingProxyType(jwt_codec.decode(jwtoken))
+        except InvalidToken:
+            return False
+        claims_cache.put(jwtoken, payload)
+        return payload
@@ -0,0 +1,160 @@
+"""
+JWS compact encoding and verification of the tokens this service issues, python-jose stays for key loading only.
+
+Encoded tokens are byte-identical to `jose.jwt.encode` with the same claims and key: header JSON with sorted keys,
+payload JSON in claim order with non-ASCII escaped, unpadded base64url. ECDSA/RSA-PSS signatures are randomized,
+so for those algorithms only header and payload segments are identical.
+Header segments of the keyring are encoded once, the HMAC key is prepared once and copied per token.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import time
+from typing import Any, Optional, Union
+
+import orjson
+from jose.backends.base import Key
+
+from services.keyring import KeyRing, keyring
+
+HMAC_DIGESTS = {'HS256': hashlib.sha256, 'HS384': hashlib.sha384, 'HS512': hashlib.sha512}
+REQUIRED_CLAIMS = ('exp', 'iat', 'sub', 'jti')
+INTEGER_CLAIMS = ('exp', 'nbf', 'iat')
+STRING_CLAIMS = ('sub', 'jti', 'iss')
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class ExpiredToken(InvalidToken):
+    pass
+
+
+def b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def b64decode(data: bytes) -> bytes:
+    """Strict unpadded base64url, characters of other alphabets are rejected instead of skipped"""
+    if b'+' in data or b'/' in data or b'=' in data:
+        raise InvalidToken('Invalid base64url segment')
+    try:
+        return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+    except (binascii.Error, ValueError):
+        raise InvalidToken('Invalid base64url segment')
+
+
+def encode_header(algorithm: str, headers: Optional[dict] = None) -> bytes:
+    return b64encode(json.dumps({'typ': 'JWT', 'alg': algorithm, **(headers or {})},
+                                separators=(',', ':'), sort_keys=True).encode())
+
+
+def encode_payload(claims: dict) -> bytes:
+    payload = orjson.dumps(claims)
+    # json.dumps, used by python-jose, escapes DEL and non-ASCII characters, orjson writes them as is
+    if not payload.isascii() or b'\x7f' in payload:
+        payload = json.dumps(claims, separators=(',', ':')).encode()
+    return b64encode(payload)
+
+
+def validate_claims(claims: Any, now: int):
+    """Same checks as `jose.jwt.decode` without audience and issuer, plus claims the service relies on"""
+    if not isinstance(claims, dict):
+        raise InvalidToken('Payload is not a JSON object')
+    for claim in REQUIRED_CLAIMS:
+        if claim not in claims:
+            raise InvalidToken(f'Missing {claim} claim')
+    for claim in INTEGER_CLAIMS:
+        if claim in claims and (type(claims[claim]) is not int):
+            raise InvalidToken(f'{claim} claim must be an integer')
+    for claim in STRING_CLAIMS:
+        if claim in claims and not isinstance(claims[claim], str):
+            raise InvalidToken(f'{claim} claim must be a string')
+    if 'aud' in claims:
+        raise InvalidToken('Audience is not accepted')
+    if claims['exp'] < now:
+        raise ExpiredToken('Signature has expired')
+    if claims.get('nbf', now) > now:
+        raise InvalidToken('Token is not yet valid')
+
+
+class JWTCodec:
+    def __init__(self, keys: KeyRing):
+        self.keyring = keys
+        self.algorithm = keys.algorithm
+        self._signing_header = encode_header(keys.algorithm, keys.headers)
+        self._hmac = None
+        if keys.symmetric:
+            if keys.algorithm not in HMAC_DIGESTS:
+                raise RuntimeError(f'Unsupported algorithm {keys.algorithm}')
+            self._hmac = hmac.new(keys.signing_key.encode(), digestmod=HMAC_DIGESTS[keys.algorithm])
+            self._keys_by_header = {self._signing_header: None}
+        else:
+            self._keys_by_header = {encode_header(keys.algorithm, {'kid': kid}): keys.verification_key(kid)
+                                    for kid in keys.kids}
+
+    def _hmac_digest(self, signing_input: bytes) -> bytes:
+        digest = self._hmac.copy()
+        digest.update(signing_input)
+        return digest.digest()
+
+    def encode(self, claims: dict) -> str:
+        """Sign claims, `exp`, `nbf` and `iat` must already be integer timestamps"""
+        signing_input = self._signing_header + b'.' + encode_payload(claims)
+        if self._hmac is not None:
+            signature = self._hmac_digest(signing_input)
+        else:
+            signature = self.keyring.signing_key.sign(signing_input)
+        return (signing_input + b'.' + b64encode(signature)).decode()
+
+    def _verification_key(self, header_segment: bytes) -> Optional[Key]:
+        if header_segment in self._keys_by_header:
+            return self._keys_by_header[header_segment]
+        try:
+            header = orjson.loads(b64decode(header_segment))
+        except orjson.JSONDecodeError:
+            raise InvalidToken('Invalid header')
+        if not isinstance(header, dict) or header.get('alg') != self.algorithm:
+            raise InvalidToken('Invalid header')
+        if self._hmac is not None:
+            return None
+        if (key := self.keyring.verification_key(header.get('kid'))) is None:
+            raise InvalidToken('Unknown key')
+        return key
+
+    def decode(self, token: Union[str, bytes], now: Optional[int] = None) -> dict:
+        """
+        Verify signature and claims, return claims
+        :raise InvalidToken: ExpiredToken if token has expired
+        """
+        if isinstance(token, str):
+            try:
+                token = token.encode('ascii')
+            except UnicodeEncodeError:
+                raise InvalidToken('Token is not ASCII')
+        if token.count(b'.') != 2:
+            raise InvalidToken('Not enough or too many segments')
+        signing_input, signature_segment = token.rsplit(b'.', 1)
+        header_segment, payload_segment = signing_input.split(b'.', 1)
+
+        key = self._verification_key(header_segment)
+        signature = b64decode(signature_segment)
+        if self._hmac is not None:
+            valid = hmac.compare_digest(self._hmac_digest(signing_input), signature)
+        else:
+            valid = key.verify(signing_input, signature)
+        if not valid:
+            raise InvalidToken('Signature verification failed')
+
+        try:
+            claims = orjson.loads(b64decode(payload_segment))
+        except orjson.JSONDecodeError:
+            raise InvalidToken('Invalid payload')
+        validate_claims(claims, int(time.time()) if now is None else now)
+        return claims
+
+
+jwt_codec = JWTCodec(keyring)
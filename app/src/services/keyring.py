@@ -0,0 +1,76 @@
+"""
+Keys used to sign and verify JWT.
+
+HMAC algorithms (HS*) use SECRET_KEY and publish nothing.
+Asymmetric algorithms (ES*, RS*, PS*) load every `<kid>.pem` private key from JWT_KEYS_DIR, e.g.
+`openssl ecparam -name prime256v1 -genkey -noout -out <kid>.pem` for ES256.
+New tokens are signed with JWT_SIGNING_KID (or the last kid in sorted order) and carry it in the `kid` header,
+every loaded key is accepted for verification and published in JWKS.
+Rotation: add the new key file and restart, so other services fetch it from JWKS; then switch JWT_SIGNING_KID;
+delete the old file once tokens signed with it have expired (REFRESH_TOKEN_EXPIRE_MINUTES).
+"""
+import os
+from typing import Optional, Union
+
+from jose import jwk
+from jose.backends.base import Key
+
+from core.config import SETTINGS
+
+SYMMETRIC_ALGORITHM_PREFIX = 'HS'
+
+
+class KeyRing:
+    def __init__(self, algorithm: str, secret_key: str, keys_dir: Optional[str] = None,
+                 signing_kid: Optional[str] = None):
+        self.algorithm = algorithm
+        self.symmetric = algorithm.startswith(SYMMETRIC_ALGORITHM_PREFIX)
+        self._secret_key = secret_key
+        self._keys: dict[str, Key] = {}
+        self._public_keys: dict[str, Key] = {}
+        self.signing_kid = None
+        if not self.symmetric:
+            self._load(keys_dir, signing_kid)
+
+    def _load(self, keys_dir: Optional[str], signing_kid: Optional[str]):
+        if not keys_dir or not os.path.isdir(keys_dir):
+            raise RuntimeError(f'JWT_KEYS_DIR must be a directory with private keys for {self.algorithm}')
+        for filename in sorted(os.listdir(keys_dir)):
+            kid, extension = os.path.splitext(filename)
+            if extension != '.pem':
+                continue
+            with open(os.path.join(keys_dir, filename)) as key_file:
+                key = jwk.construct(key_file.read(), algorithm=self.algorithm)
+            self._keys[kid] = key
+            self._public_keys[kid] = key.public_key()
+        if not self._keys:
+            raise RuntimeError(f'No *.pem keys found in {keys_dir}')
+        self.signing_kid = signing_kid or list(self._keys)[-1]
+        if self.signing_kid not in self._keys:
+            raise RuntimeError(f'Signing key {self.signing_kid} not found in {keys_dir}')
+
+    @property
+    def signing_key(self) -> Union[str, Key]:
+        return self._secret_key if self.symmetric else self._keys[self.signing_kid]
+
+    @property
+    def headers(self) -> Optional[dict]:
+        return None if self.symmetric else {'kid': self.signing_kid}
+
+    @property
+    def kids(self) -> list[str]:
+        return list(self._public_keys)
+
+    def verification_key(self, kid: Optional[str]) -> Optional[Union[str, Key]]:
+        if self.symmetric:
+            return self._secret_key
+        return self._public_keys.get(kid)
+
+    def jwks(self) -> dict:
+        return {
+            'keys': [{**key.to_dict(), 'kid': kid, 'use': 'sig'} for kid, key in self._public_keys.items()]
+        }
+
+
+keyring = KeyRing(algorithm=SETTINGS.JWT.ALGORITHM, secret_key=SETTINGS.JWT.SECRET_KEY,
+                  keys_dir=SETTINGS.JWT.JWT_KEYS_DIR, signing_kid=SETTINGS.JWT.JWT_SIGNING_KID)
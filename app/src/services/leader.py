@@ -0,0 +1,45 @@
+import uuid
+
+from redis.asyncio.client import Redis
+
+from db.redis_inj import LuaScript
+
+# extend the lease only while it is still ours, a lease taken over by another worker is left alone
+_RENEW_SCRIPT = LuaScript("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+_RELEASE_SCRIPT = LuaScript("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+class LeaderLock:
+    """
+    Redis lease electing one worker of the fleet for background jobs.
+    The holder calls `acquire` more often than `ttl` to keep the lease, a dead holder loses it after `ttl`.
+    """
+
+    def __init__(self, name: str, ttl: float):
+        self.name = name
+        self.ttl_ms = int(ttl * 1000)
+        self._token = uuid.uuid4().hex
+        self.is_leader = False
+
+    async def acquire(self, redis: Redis) -> bool:
+        """Take the lease or extend it if this worker already holds it"""
+        if self.is_leader and await _RENEW_SCRIPT(redis, keys=(self.name,), args=(self._token, self.ttl_ms)):
+            return True
+        self.is_leader = bool(await redis.set(self.name, self._token, nx=True, px=self.ttl_ms))
+        return self.is_leader
+
+    async def release(self, redis: Redis):
+        if self.is_leader:
+            await _RELEASE_SCRIPT(redis, keys=(self.name,), args=(self._token,))
+            self.is_leader = False
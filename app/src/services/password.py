@@ -1,6 +1,46 @@
+import asyncio
+import multiprocessing
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from typing import Optional, Callable
+
+from fastapi import HTTPException
 from passlib.context import CryptContext
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from core.config import SETTINGS
+from core.metrics import PASSWORD_HASH_LATENCY
+
+CALIBRATION_PASSWORD = 'calibration-password'
+MAX_BCRYPT_ROUNDS = 31
+MAX_ARGON2_TIME_COST = 64
+
+
+def build_password_context(schemes: list[str] = None, bcrypt_rounds: int = None,
+                           argon2_time_cost: int = None) -> CryptContext:
+    """
+    Hashing context from settings. Cost is pinned (min = default = max), so `needs_update` reports every hash
+    made with another cost or a deprecated scheme, whether the cost was raised or lowered.
+    """
+    settings = SETTINGS.PASSWORD
+    schemes = schemes or settings.PASSWORD_HASH_SCHEMES
+    options = {}
+    if 'bcrypt' in schemes:
+        rounds = bcrypt_rounds or settings.PASSWORD_BCRYPT_ROUNDS
+        options.update(bcrypt__default_rounds=rounds, bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds)
+    if 'argon2' in schemes:
+        time_cost = argon2_time_cost or settings.PASSWORD_ARGON2_TIME_COST
+        options.update(argon2__default_rounds=time_cost, argon2__min_rounds=time_cost,
+                       argon2__max_rounds=time_cost, argon2__memory_cost=settings.PASSWORD_ARGON2_MEMORY_COST,
+                       argon2__parallelism=settings.PASSWORD_ARGON2_PARALLELISM)
+    return CryptContext(schemes=schemes, deprecated='auto', **options)
+
+
+password_context = build_password_context()
+
+_executor: Optional[ProcessPoolExecutor] = None
+_pending = 0
 
 
 def get_hashed_password(password: str) -> str:
@@ -9,3 +49,87 @@ def get_hashed_password(password: str) -> str:
 
 def verify_password(password: str, hashed_pass: str) -> bool:
     return password_context.verify(password, hashed_pass)
+
+
+def password_needs_update(hashed_pass: str) -> bool:
+    """Hash was made with a deprecated scheme or another cost, cheap enough for the event loop"""
+    return SETTINGS.PASSWORD.PASSWORD_REHASH_ON_LOGIN and password_context.needs_update(hashed_pass)
+
+
+def _hash_seconds(context: CryptContext, samples: int) -> float:
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        context.hash(CALIBRATION_PASSWORD)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def calibrate(scheme: str, target_seconds: float, samples: int = 3) -> tuple[dict[str, int], float]:
+    """
+    Find the highest cost of `scheme` whose hash takes at most `target_seconds` on this host.
+    Argon2 memory and parallelism are taken from settings, only time cost is searched.
+    :return: settings to use and median hash time with them
+    """
+    if scheme == 'bcrypt':
+        setting, option, cost, max_cost = 'PASSWORD_BCRYPT_ROUNDS', 'bcrypt_rounds', 4, MAX_BCRYPT_ROUNDS
+    elif scheme == 'argon2':
+        setting, option, cost, max_cost = 'PASSWORD_ARGON2_TIME_COST', 'argon2_time_cost', 1, MAX_ARGON2_TIME_COST
+    else:
+        raise ValueError(f'Calibration of {scheme} is not supported')
+    seconds = _hash_seconds(build_password_context(schemes=[scheme], **{option: cost}), samples)
+    while cost < max_cost:
+        next_seconds = _hash_seconds(build_password_context(schemes=[scheme], **{option: cost + 1}), samples)
+        if next_seconds > target_seconds:
+            break
+        cost, seconds = cost + 1, next_seconds
+    return {setting: cost}, seconds
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Process pool is created lazily, so every gunicorn worker gets its own one after fork"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=SETTINGS.PASSWORD.PASSWORD_HASH_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+async def _run_in_pool(operation: str, fn: Callable, *args):
+    """
+    Run CPU-bound hashing function in the process pool
+    :raise HTTPException: 503 if too many hashing operations are already pending in this worker
+    """
+    global _pending
+    if _pending >= SETTINGS.PASSWORD.PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                            detail="Too many pending password operations, try again later.",
+                            headers={'Retry-After': '1'})
+    _pending += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), fn, *args)
+    finally:
+        _pending -= 1
+        PASSWORD_HASH_LATENCY.labels(operation).observe(time.perf_counter() - started)
+
+
+async def get_hashed_password_async(password: str) -> str:
+    return await _run_in_pool('hash', get_hashed_password, password)
+
+
+async def verify_password_async(password: str, hashed_pass: str) -> bool:
+    return await _run_in_pool('verify', verify_password, password, hashed_pass)
+
+
+async def warm_up_password_executor():
+    """Start every pool process before the first login, spawning a process takes hundreds of milliseconds"""
+    executor, loop = _get_executor(), asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(executor, int) for _ in range(SETTINGS.PASSWORD.PASSWORD_HASH_WORKERS)))
+
+
+def shutdown_password_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
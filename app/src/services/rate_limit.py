@@ -0,0 +1,154 @@
+"""
+Token buckets for /login, kept in Redis and shared by the fleet: one per client IP, one per email and a global one.
+A request takes a token from every bucket or from none of them, in one Lua script.
+A worker that saw a bucket empty remembers until when, and rejects that client again without asking Redis.
+"""
+import ipaddress
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from http import HTTPStatus
+from typing import Annotated
+
+from fastapi import Depends, Form, HTTPException, Request
+from redis.asyncio.client import Redis
+
+from core.config import SETTINGS
+from core.metrics import RATE_LIMITED
+from db.redis_inj import LuaScript, get_redis
+from models.models import HTTPErrorDetails
+
+# ARGV holds capacity and refill window (seconds) of every bucket in KEYS.
+# Returns 0 when the tokens are taken, otherwise {seconds until a token is available, 1-based index of the bucket}
+_TAKE_SCRIPT = LuaScript("""
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local tokens = {}
+local retry_after, blocked = 0, 0
+for i, key in ipairs(KEYS) do
+    local capacity, window = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(state[1]) or capacity
+    local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+    available = math.min(capacity, available + elapsed * capacity / window)
+    tokens[i] = available
+    if available < 1 then
+        local wait = (1 - available) * window / capacity
+        if wait > retry_after then
+            retry_after, blocked = wait, i
+        end
+    end
+end
+if blocked > 0 then
+    return {tostring(retry_after), blocked}
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tostring(tokens[i] - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', key, ARGV[2 * i])
+end
+return 0
+""")
+
+
+@dataclass(frozen=True)
+class Bucket:
+    scope: str
+    key: str
+    capacity: int
+    window: int
+
+
+class BlockedClients:
+    """Per-worker LRU of buckets known to be empty and the time they get a token again"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._until: OrderedDict[str, float] = OrderedDict()
+
+    def retry_after(self, key: str, now: float) -> float:
+        until = self._until.get(key)
+        if until is None:
+            return 0
+        if until <= now:
+            del self._until[key]
+            return 0
+        return until - now
+
+    def block(self, key: str, until: float):
+        self._until[key] = until
+        self._until.move_to_end(key)
+        if len(self._until) > self.maxsize:
+            self._until.popitem(last=False)
+
+    def clear(self):
+        self._until.clear()
+
+
+blocked_clients = BlockedClients(maxsize=SETTINGS.RATE_LIMIT.LOGIN_RATE_BLOCKED_CACHE_SIZE)
+
+_trusted_proxies = [ipaddress.ip_network(network, strict=False) for network in SETTINGS.RATE_LIMIT.TRUSTED_PROXIES]
+
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in _trusted_proxies)
+
+
+def client_ip(request: Request) -> str:
+    """
+    Address of the client, not of the proxy in front of the service. X-Forwarded-For is read only when the peer
+    is one of TRUSTED_PROXIES: its addresses are walked from the right and the first one that is not a trusted proxy
+    is the client, so a client can not choose its address by sending the header itself
+    """
+    peer = request.client.host if request.client else 'unknown'
+    if not _is_trusted_proxy(peer):
+        return peer
+    forwarded = [address.strip() for header in request.headers.getlist('x-forwarded-for')
+                 for address in header.split(',') if address.strip()]
+    for address in reversed(forwarded):
+        if not _is_trusted_proxy(address):
+            return address
+    return forwarded[0] if forwarded else peer
+
+
+def _too_many_requests(retry_after: float) -> HTTPException:
+    return HTTPException(status_code=HTTPStatus.TOO_MANY_REQUESTS, detail=HTTPErrorDetails.TOO_MANY_REQUESTS.value,
+                         headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+
+async def take_tokens(redis: Redis, buckets: list[Bucket]):
+    """Take a token from every bucket, raise 429 with Retry-After if one of them is empty"""
+    now = time.time()
+    for bucket in buckets:
+        if retry_after := blocked_clients.retry_after(bucket.key, now):
+            RATE_LIMITED.labels(bucket.scope, 'local').inc()
+            raise _too_many_requests(retry_after)
+
+    args = [value for bucket in buckets for value in (bucket.capacity, bucket.window)]
+    result = await _TAKE_SCRIPT(redis, keys=tuple(bucket.key for bucket in buckets), args=tuple(args))
+    if result:
+        retry_after, blocked = float(result[0]), buckets[int(result[1]) - 1]
+        blocked_clients.block(blocked.key, now + retry_after)
+        RATE_LIMITED.labels(blocked.scope, 'redis').inc()
+        raise _too_many_requests(retry_after)
+
+
+def login_buckets(ip: str, email: str) -> list[Bucket]:
+    settings = SETTINGS.RATE_LIMIT
+    return [
+        Bucket('global', 'rate:login:global', settings.LOGIN_RATE_GLOBAL_LIMIT, settings.LOGIN_RATE_GLOBAL_WINDOW),
+        Bucket('ip', f'rate:login:ip:{ip}', settings.LOGIN_RATE_IP_LIMIT, settings.LOGIN_RATE_IP_WINDOW),
+        Bucket('email', f'rate:login:email:{email.lower()}', settings.LOGIN_RATE_EMAIL_LIMIT,
+               settings.LOGIN_RATE_EMAIL_WINDOW),
+    ]
+
+
+async def login_rate_limit(request: Request, email: Annotated[str, Form()], redis: Redis = Depends(get_redis)):
+    """Dependency of /login, rejects the attempt before the user lookup and password check"""
+    if not SETTINGS.RATE_LIMIT.LOGIN_RATE_LIMIT_ENABLED:
+        return
+    await take_tokens(redis, login_buckets(ip=client_ip(request), email=email))
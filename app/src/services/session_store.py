@@ -0,0 +1,137 @@
+"""
+Redis-primary store of refresh sessions, used with SESSION_STORE=redis.
+Every session of a user lives in one hash `device_sessions:<user_id>` mapping hex ua_fingerprint of the user agent
+to "<jti> <issued_at>".
+Each change is applied and appended to the write-behind stream by one script, so Redis and the stream never
+disagree; services.session_write_behind persists the stream to content.refresh_tokens.
+"""
+import datetime
+import time
+import uuid
+from typing import NamedTuple, Optional, Union
+
+from redis.asyncio.client import Redis
+
+from core.config import SETTINGS
+from db.redis_inj import LuaScript
+from services.useragent import ua_fingerprint
+
+# hashes keyed by raw user agent lived under `sessions:`, the new prefix makes the leader reload them from Postgres
+RECOVERED_KEY = 'device_sessions:recovered'
+
+# with ARGV[7] set the session is rotated only if its current jti is ARGV[7], otherwise it is deleted.
+# A missing session proves nothing until sessions are recovered after Redis lost its data (KEYS[3] is absent)
+_UPSERT_SCRIPT = LuaScript("""
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+if ARGV[7] ~= '' and (not previous or string.sub(previous, 1, #ARGV[7] + 1) ~= ARGV[7] .. ' ') then
+    if not previous and redis.call('EXISTS', KEYS[3]) == 0 then
+        return {-1, ''}
+    end
+    if previous then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+        redis.call('XADD', KEYS[2], '*', 'op', 'delete', 'user_id', ARGV[5], 'ua_fingerprint', ARGV[1])
+    end
+    return {0, previous or ''}
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2] .. ' ' .. ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('XADD', KEYS[2], '*', 'op', 'upsert', 'user_id', ARGV[5], 'ua_fingerprint', ARGV[1],
+           'useragent', ARGV[6], 'jti', ARGV[2], 'issued_at', ARGV[3])
+return {1, previous or ''}
+""")
+
+_DELETE_SCRIPT = LuaScript("""
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('XADD', KEYS[2], '*', 'op', 'delete', 'user_id', ARGV[2], 'ua_fingerprint', ARGV[1])
+return previous
+""")
+
+_DELETE_ALL_SCRIPT = LuaScript("""
+local sessions = redis.call('HVALS', KEYS[1])
+redis.call('DEL', KEYS[1])
+redis.call('XADD', KEYS[2], '*', 'op', 'delete_all', 'user_id', ARGV[1])
+return sessions
+""")
+
+
+class StoredToken(NamedTuple):
+    """Refresh token as it is stored: its jti and when the session got it"""
+    jti: uuid.UUID
+    issued_at: datetime.datetime
+
+
+class TokenReuseDetected(Exception):
+    """Presented refresh token is not the current one of its session, the session was deleted"""
+
+    def __init__(self, current: Optional[StoredToken]):
+        super().__init__('Refresh token is not the current token of its session')
+        self.current = current
+
+
+class SessionsNotRecovered(Exception):
+    """Session was not found, but sessions are still being reloaded from Postgres, so it may exist"""
+
+    def __init__(self):
+        super().__init__('Refresh sessions are not recovered yet')
+
+
+def sessions_key(user_id) -> str:
+    return f'device_sessions:{user_id}'
+
+
+def session_field(useragent: str) -> str:
+    return ua_fingerprint(useragent).hex()
+
+
+def encode_session(jti, issued_at: datetime.datetime) -> str:
+    return f'{jti} {issued_at.timestamp()}'
+
+
+def _decode_session(value: Optional[Union[str, bytes]]) -> Optional[StoredToken]:
+    if not value:
+        return None
+    jti, issued_at = (value.decode() if isinstance(value, bytes) else value).split(' ')
+    return StoredToken(jti=uuid.UUID(jti),
+                       issued_at=datetime.datetime.fromtimestamp(float(issued_at), tz=datetime.timezone.utc))
+
+
+def session_ttl() -> int:
+    return 60 * SETTINGS.JWT.REFRESH_TOKEN_EXPIRE_MINUTES
+
+
+class RedisSessionStore:
+    """Refresh sessions of services.crud.refresh_tokens kept in Redis, same semantics as the Postgres ones"""
+
+    @property
+    def stream(self) -> str:
+        return SETTINGS.SESSIONS.SESSION_WRITE_BEHIND_STREAM
+
+    async def get(self, redis: Redis, useragent: str, user_id: uuid.UUID) -> Optional[StoredToken]:
+        return _decode_session(await redis.hget(sessions_key(user_id), session_field(useragent)))
+
+    async def upsert(self, redis: Redis, jti: uuid.UUID, useragent: str, user_id: uuid.UUID,
+                     expected_jti: Optional[str] = None) -> Optional[StoredToken]:
+        """Rotate refresh token of the session, return the previous one (None if session is new).
+        With expected_jti the session must currently hold that token, see upsert_token
+        :raise SessionsNotRecovered: with expected_jti, if the session is missing before sessions are recovered"""
+        applied, previous = await _UPSERT_SCRIPT(redis, keys=(sessions_key(user_id), self.stream, RECOVERED_KEY),
+                                                 args=(session_field(useragent), str(jti), repr(time.time()),
+                                                       session_ttl(), str(user_id), useragent, expected_jti or ''))
+        if applied == -1:
+            raise SessionsNotRecovered
+        if not applied:
+            raise TokenReuseDetected(_decode_session(previous))
+        return _decode_session(previous)
+
+    async def delete(self, redis: Redis, useragent: str, user_id: uuid.UUID) -> Optional[StoredToken]:
+        previous = await _DELETE_SCRIPT(redis, keys=(sessions_key(user_id), self.stream),
+                                        args=(session_field(useragent), str(user_id)))
+        return _decode_session(previous)
+
+    async def delete_all(self, redis: Redis, user_id: uuid.UUID) -> list[StoredToken]:
+        sessions = await _DELETE_ALL_SCRIPT(redis, keys=(sessions_key(user_id), self.stream), args=(str(user_id),))
+        return [_decode_session(session) for session in sessions]
+
+
+session_store = RedisSessionStore()
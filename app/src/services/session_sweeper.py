@@ -0,0 +1,76 @@
+"""
+Garbage collection of refresh sessions whose token has expired, which only /logout would delete otherwise.
+Runs as `python manage.py sweep-sessions` (e.g. from cron) or, with SESSION_SWEEP_ENABLED, every
+SESSION_SWEEP_INTERVAL seconds in the worker holding the Redis lease.
+Sessions are deleted SESSION_SWEEP_BATCH_SIZE at a time, each batch in its own short transaction,
+with a SESSION_SWEEP_PAUSE between batches to leave room for request traffic.
+"""
+import asyncio
+import logging
+from typing import Optional, Awaitable, Callable
+
+from redis.asyncio.client import Redis
+
+from core.config import SETTINGS
+from core.metrics import SESSIONS_SWEPT
+from db.database import async_session
+from services.crud.refresh_tokens import delete_expired_tokens
+from services.leader import LeaderLock
+
+logger = logging.getLogger(__name__)
+
+
+async def sweep_expired_sessions(keep_going: Callable[[], Awaitable[bool]] = None) -> int:
+    """
+    Delete expired sessions batch by batch until none is left
+    :param keep_going: asked before every next batch, e.g. whether the lease is still held
+    :return: number of deleted sessions
+    """
+    settings = SETTINGS.SESSIONS
+    swept = 0
+    while True:
+        async with async_session() as db:
+            deleted = await delete_expired_tokens(db=db, batch_size=settings.SESSION_SWEEP_BATCH_SIZE,
+                                                  lock_timeout_ms=settings.SESSION_SWEEP_LOCK_TIMEOUT_MS)
+        swept += deleted
+        SESSIONS_SWEPT.inc(deleted)
+        if deleted < settings.SESSION_SWEEP_BATCH_SIZE or (keep_going and not await keep_going()):
+            return swept
+        await asyncio.sleep(settings.SESSION_SWEEP_PAUSE)
+
+
+class SessionSweeper:
+    def __init__(self):
+        # lease outlives the interval, so the same worker keeps sweeping while it is alive
+        self._lock = LeaderLock('session_sweeper:leader', ttl=2 * SETTINGS.SESSIONS.SESSION_SWEEP_INTERVAL)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, redis: Redis):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(redis))
+
+    async def stop(self, redis: Redis):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._lock.release(redis)
+
+    async def _run(self, redis: Redis):
+        while True:
+            try:
+                if await self._lock.acquire(redis):
+                    if swept := await sweep_expired_sessions(keep_going=lambda: self._lock.acquire(redis)):
+                        logger.info('Deleted %s expired refresh sessions', swept)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Expired session sweep failed, retrying in the next interval')
+            await asyncio.sleep(SETTINGS.SESSIONS.SESSION_SWEEP_INTERVAL)
+
+
+session_sweeper = SessionSweeper()
@@ -0,0 +1,173 @@
+"""
+Write-behind of refresh sessions kept in Redis (SESSION_STORE=redis) to content.refresh_tokens.
+One worker of the fleet, elected with a Redis lease, reads the change stream in order and applies
+up to SESSION_WRITE_BEHIND_BATCH_SIZE changes per transaction every SESSION_WRITE_BEHIND_INTERVAL seconds.
+Changes are acknowledged only after commit, so a new leader replays what the previous one did not persist.
+When Redis loses its data (no RECOVERED_KEY) the leader reloads active sessions from Postgres.
+"""
+import asyncio
+import datetime
+import logging
+import time
+import uuid
+from typing import Optional
+
+from redis.asyncio.client import Redis
+from redis.exceptions import ResponseError
+
+from core.config import SETTINGS
+from core.metrics import SESSION_WRITE_BEHIND_LAG
+from db.database import async_session
+from services.crud.refresh_tokens import apply_session_changes, stream_active_sessions
+from services.leader import LeaderLock
+from services.session_store import RECOVERED_KEY, sessions_key, encode_session, session_ttl
+from services.useragent import ua_fingerprint
+
+logger = logging.getLogger(__name__)
+
+GROUP = 'write_behind'
+# every leader reads as the same consumer, so entries delivered to a dead leader are pending for the next one
+CONSUMER = 'leader'
+RECOVERY_BATCH_SIZE = 1000
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def coalesce_changes(entries: list) -> tuple[list[dict], list[tuple[uuid.UUID, bytes]], list[uuid.UUID]]:
+    """Reduce stream entries to the last change per session, see apply_session_changes"""
+    sessions: dict[tuple[uuid.UUID, bytes], Optional[dict]] = {}
+    deleted_users: set[uuid.UUID] = set()
+    for _, fields in entries:
+        fields = {_text(key): _text(value) for key, value in fields.items()}
+        user_id = uuid.UUID(fields['user_id'])
+        if fields['op'] == 'delete_all':
+            deleted_users.add(user_id)
+            for session in [session for session in sessions if session[0] == user_id]:
+                del sessions[session]
+            continue
+        # entries written before sessions were keyed by fingerprint carry only the user agent
+        fingerprint = bytes.fromhex(fields['ua_fingerprint']) if 'ua_fingerprint' in fields \
+            else ua_fingerprint(fields['useragent'])
+        if fields['op'] == 'delete':
+            sessions[(user_id, fingerprint)] = None
+        else:
+            sessions[(user_id, fingerprint)] = {
+                'user_id': user_id, 'useragent': fields['useragent'], 'ua_fingerprint': fingerprint,
+                'jti': uuid.UUID(fields['jti']),
+                'issued_at': datetime.datetime.fromtimestamp(float(fields['issued_at']), tz=datetime.timezone.utc),
+            }
+    upserts = [change for change in sessions.values() if change is not None]
+    deleted = [session for session, change in sessions.items() if change is None]
+    return upserts, deleted, list(deleted_users)
+
+
+class SessionWriteBehind:
+    def __init__(self):
+        self._lock = LeaderLock(f'{SETTINGS.SESSIONS.SESSION_WRITE_BEHIND_STREAM}:leader',
+                                ttl=SETTINGS.SESSIONS.SESSION_WRITE_BEHIND_LOCK_TTL)
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def stream(self) -> str:
+        return SETTINGS.SESSIONS.SESSION_WRITE_BEHIND_STREAM
+
+    def start(self, redis: Redis):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(redis))
+
+    async def stop(self, redis: Redis):
+        """Stop the loop, the leader persists what is left in the stream and hands the lease over"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._lock.is_leader:
+            try:
+                await self._drain(redis)
+            finally:
+                await self._lock.release(redis)
+
+    async def _run(self, redis: Redis):
+        while True:
+            try:
+                if await self._lock.acquire(redis):
+                    await self._ensure_recovered(redis)
+                    await self._drain(redis)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Session write-behind failed, retrying')
+            await asyncio.sleep(SETTINGS.SESSIONS.SESSION_WRITE_BEHIND_INTERVAL)
+
+    async def _drain(self, redis: Redis):
+        """Flush batches while they come full, keeping the lease between batches"""
+        while await self.flush(redis) == SETTINGS.SESSIONS.SESSION_WRITE_BEHIND_BATCH_SIZE:
+            if not await self._lock.acquire(redis):
+                return
+
+    async def flush(self, redis: Redis) -> int:
+        """Persist one batch of changes, return how many stream entries it had"""
+        entries = []
+        for start_id in ('0', '>'):
+            try:
+                response = await redis.xreadgroup(GROUP, CONSUMER, {self.stream: start_id},
+                                                  count=SETTINGS.SESSIONS.SESSION_WRITE_BEHIND_BATCH_SIZE)
+            except ResponseError as error:
+                if 'NOGROUP' not in str(error):
+                    raise
+                await self._create_group(redis)
+                return 0
+            if response and (entries := response[0][1]):
+                break
+        if not entries:
+            return 0
+        upserts, deleted, deleted_users = coalesce_changes(entries)
+        async with async_session() as db:
+            await apply_session_changes(db, upserts=upserts, deleted=deleted, deleted_users=deleted_users)
+        committed_at = time.time()
+        ids = [entry_id for entry_id, _ in entries]
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.xack(self.stream, GROUP, *ids)
+            pipe.xdel(self.stream, *ids)
+            await pipe.execute()
+        for entry_id in ids:
+            SESSION_WRITE_BEHIND_LAG.observe(committed_at - int(_text(entry_id).split('-')[0]) / 1000)
+        return len(entries)
+
+    async def _create_group(self, redis: Redis):
+        try:
+            await redis.xgroup_create(self.stream, GROUP, id='0', mkstream=True)
+        except ResponseError as error:
+            if 'BUSYGROUP' not in str(error):
+                raise
+
+    async def _ensure_recovered(self, redis: Redis):
+        if not await redis.exists(RECOVERED_KEY):
+            await self._create_group(redis)
+            await self.recover(redis)
+
+    async def recover(self, redis: Redis):
+        """Load active sessions from Postgres without overwriting sessions changed in Redis meanwhile.
+        Sessions deleted in Redis during recovery may come back, their tokens are blacklisted anyway."""
+        logger.warning('Redis has no refresh sessions, loading them from Postgres')
+        loaded = 0
+        async with async_session() as db:
+            pipe = redis.pipeline(transaction=False)
+            async for user_id, fingerprint, jti, issued_at in stream_active_sessions(db, RECOVERY_BATCH_SIZE):
+                pipe.hsetnx(sessions_key(user_id), fingerprint.hex(), encode_session(jti, issued_at))
+                pipe.expire(sessions_key(user_id), session_ttl())
+                loaded += 1
+                if loaded % RECOVERY_BATCH_SIZE == 0:
+                    await pipe.execute()
+            await pipe.execute()
+        await redis.set(RECOVERED_KEY, int(time.time()))
+        logger.warning('Loaded %s refresh sessions from Postgres', loaded)
+
+
+session_write_behind = SessionWriteBehind()
@@ -0,0 +1,167 @@
+"""
+Two-tier read-through cache of compact user records: per-worker LRU in front of Redis.
+Records include the password hash, because login is the main reader.
+Writers call `invalidate`, which deletes Redis keys and tells other workers to drop their local copies.
+It also leaves a tombstone for USER_CACHE_TOMBSTONE_TTL seconds. `put` skips caching while the tombstone exists,
+so a reader that loaded the row before the write can not put the old record back.
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+import orjson
+from redis.asyncio.client import Redis
+
+from core.config import SETTINGS
+from db.redis_inj import get_redis, LuaScript
+from services.broadcast import broadcast
+
+
+@dataclass(frozen=True, slots=True)
+class CachedUser:
+    id: str
+    username: str
+    email: str
+    password_hash: str
+
+
+@dataclass(slots=True)
+class _Entry:
+    user: CachedUser
+    expires_at: float
+    last_hit_at: float = 0.0
+
+
+def _id_key(user_id: str) -> str:
+    return f'user:id:{user_id}'
+
+
+def _email_key(email: str) -> str:
+    return f'user:email:{email}'
+
+
+def _tombstone_key(user_id: str) -> str:
+    return f'user:invalidated:{user_id}'
+
+
+_PUT_SCRIPT = LuaScript("""
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+return 1
+""")
+
+
+class UserCache:
+    def __init__(self):
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._ids_by_email: dict[str, str] = {}
+        self.ready = False
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.stale_reads = 0
+        self.invalidations = 0
+
+    def _get_local(self, user_id: Optional[str]) -> Optional[CachedUser]:
+        if not self.ready or user_id is None or (entry := self._entries.get(user_id)) is None:
+            return None
+        now = time.time()
+        if entry.expires_at <= now:
+            self._drop_local(user_id)
+            return None
+        entry.last_hit_at = now
+        self._entries.move_to_end(user_id)
+        self.local_hits += 1
+        return entry.user
+
+    def _put_local(self, user: CachedUser):
+        if not self.ready:
+            return
+        self._drop_local(user.id)
+        self._entries[user.id] = _Entry(user=user, expires_at=time.time() + SETTINGS.USER_CACHE.USER_CACHE_LOCAL_TTL)
+        self._ids_by_email[user.email] = user.id
+        if len(self._entries) > SETTINGS.USER_CACHE.USER_CACHE_SIZE:
+            _, evicted = self._entries.popitem(last=False)
+            self._ids_by_email.pop(evicted.user.email, None)
+
+    def _drop_local(self, user_id: str) -> Optional[_Entry]:
+        if (entry := self._entries.pop(user_id, None)) is not None:
+            self._ids_by_email.pop(entry.user.email, None)
+        return entry
+
+    async def _get_remote(self, key: str) -> Optional[CachedUser]:
+        redis = await get_redis()
+        if raw := await redis.get(key):
+            self.redis_hits += 1
+            user = CachedUser(**orjson.loads(raw))
+            self._put_local(user)
+            return user
+        self.misses += 1
+        return None
+
+    async def get_by_id(self, user_id: str) -> Optional[CachedUser]:
+        return self._get_local(str(user_id)) or await self._get_remote(_id_key(str(user_id)))
+
+    async def get_by_email(self, email: str) -> Optional[CachedUser]:
+        return self._get_local(self._ids_by_email.get(email)) or await self._get_remote(_email_key(email))
+
+    async def put(self, user) -> CachedUser:
+        """Cache user ORM instance in both tiers, unless the user was invalidated recently"""
+        cached = CachedUser(id=str(user.id), username=user.username, email=user.email,
+                            password_hash=user.password_hash)
+        if await _PUT_SCRIPT(await get_redis(),
+                             keys=(_id_key(cached.id), _email_key(cached.email), _tombstone_key(cached.id)),
+                             args=(orjson.dumps(asdict(cached)), SETTINGS.USER_CACHE.USER_CACHE_TTL)):
+            self._put_local(cached)
+        return cached
+
+    async def invalidate(self, user_id, *emails: str):
+        """Drop user from both tiers in every worker, `emails` are addresses the user may be cached under"""
+        user_id = str(user_id)
+        self._drop_local(user_id)
+        redis = await get_redis()
+        keys = [_id_key(user_id), *map(_email_key, emails)]
+        if raw := await redis.get(_id_key(user_id)):
+            keys.append(_email_key(orjson.loads(raw)['email']))
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(_tombstone_key(user_id), 1, ex=SETTINGS.USER_CACHE.USER_CACHE_TOMBSTONE_TTL)
+            pipe.delete(*keys)
+            pipe.publish(SETTINGS.USER_CACHE.USER_CACHE_CHANNEL, f'{user_id} {time.time()}')
+            await pipe.execute()
+
+    def on_message(self, data: str):
+        user_id, invalidated_at = data.split(' ')
+        self.invalidations += 1
+        if (entry := self._drop_local(user_id)) is not None and entry.last_hit_at > float(invalidated_at):
+            self.stale_reads += 1
+
+    async def on_connect(self, redis: Redis):
+        self._entries.clear()
+        self._ids_by_email.clear()
+        self.ready = True
+
+    def on_disconnect(self):
+        """Invalidations may be missed while disconnected, so the local tier is bypassed"""
+        self.ready = False
+
+    def stats(self) -> dict:
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            'ready': self.ready,
+            'size': len(self._entries),
+            'local_hits': self.local_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'stale_reads': self.stale_reads,
+            'invalidations': self.invalidations,
+            'hit_rate': (self.local_hits + self.redis_hits) / lookups if lookups else 0.0,
+        }
+
+
+user_cache = UserCache()
+broadcast.subscribe(SETTINGS.USER_CACHE.USER_CACHE_CHANNEL, on_message=user_cache.on_message,
+                    on_connect=user_cache.on_connect, on_disconnect=user_cache.on_disconnect)
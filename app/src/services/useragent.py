@@ -0,0 +1,12 @@
+"""
+User agents identify refresh sessions by a fixed-width fingerprint instead of the raw, unbounded header:
+the first 16 bytes of SHA-256 of the UTF-8 encoded header. The same value is computed in SQL by the
+ua_fingerprint migration, keep both in sync.
+"""
+import hashlib
+
+FINGERPRINT_SIZE = 16
+
+
+def ua_fingerprint(useragent: str) -> bytes:
+    return hashlib.sha256(useragent.encode()).digest()[:FINGERPRINT_SIZE]
@@ -0,0 +1,18 @@
+"""
+Benchmarks of the auth service.
+
+    pip install -r app/requirements.txt -r benchmarks/requirements.txt
+    python -m benchmarks load --concurrency 50 --users 500 --out results/before.json
+    python -m benchmarks micro --out results/micro-before.json
+    python -m benchmarks compare results/before.json results/after.json
+
+`load` boots `main:app` in-process (or hits `--url`) against a local Postgres from `.env`;
+with `--fake-redis` Redis is replaced by an in-process fakeredis server.
+Postgres has no in-process stand-in: run `docker-compose up db` and `alembic upgrade head` first.
+"""
+import os
+import sys
+
+APP_SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'src')
+if APP_SRC not in sys.path:
+    sys.path.insert(0, APP_SRC)
@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import sys
+
+from benchmarks.harness import write_results, compare
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Auth service benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help='drive /signup, /login, /reroll and /logout concurrently')
+    load.add_argument('--users', type=int, default=200)
+    load.add_argument('--concurrency', type=int, default=20)
+    load.add_argument('--rerolls', type=int, default=3, help='token rerolls per user session')
+    load.add_argument('--url', help='benchmark a running server instead of booting main:app in-process')
+    load.add_argument('--fake-redis', action='store_true', help='use in-process fakeredis instead of Redis')
+    load.add_argument('--out', help='write JSON results to this file')
+
+    micro = commands.add_parser('micro', help='micro-benchmarks of JWT, password and CRUD helpers')
+    micro.add_argument('--iterations', type=int, default=2000)
+    micro.add_argument('--password-iterations', type=int, default=20)
+    micro.add_argument('--no-db', action='store_true', help='skip CRUD benchmarks that need Postgres')
+    micro.add_argument('--out', help='write JSON results to this file')
+
+    imports = commands.add_parser('imports', help='import time of the app in fresh interpreters')
+    imports.add_argument('--module', default='main')
+    imports.add_argument('--repeat', type=int, default=10)
+    imports.add_argument('--top', type=int, default=15, help='number of slowest top-level imports to report')
+    imports.add_argument('--out', help='write JSON results to this file')
+
+    diff = commands.add_parser('compare', help='compare two JSON results')
+    diff.add_argument('baseline')
+    diff.add_argument('candidate')
+    diff.add_argument('--threshold', type=float, default=5.0, help='regression threshold, percent')
+
+    args = parser.parse_args()
+    if args.command == 'load':
+        from benchmarks.load import run_load
+        results = asyncio.run(run_load(users=args.users, concurrency=args.concurrency, rerolls=args.rerolls,
+                                       url=args.url, fake_redis=args.fake_redis))
+        params = {key: value for key, value in vars(args).items() if key not in ('command', 'out')}
+        write_results(args.out, 'load', params, results)
+    elif args.command == 'micro':
+        from benchmarks.micro import run_micro
+        results = asyncio.run(run_micro(iterations=args.iterations, password_iterations=args.password_iterations,
+                                        with_db=not args.no_db))
+        params = {key: value for key, value in vars(args).items() if key not in ('command', 'out')}
+        write_results(args.out, 'micro', params, results)
+    elif args.command == 'imports':
+        from benchmarks.imports import run_imports
+        results = run_imports(module=args.module, repeat=args.repeat, top=args.top)
+        params = {key: value for key, value in vars(args).items() if key not in ('command', 'out')}
+        write_results(args.out, 'imports', params, results)
+    else:
+        sys.exit(1 if compare(args.baseline, args.candidate, args.threshold) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Samples:
+    """Latencies of one benchmarked operation, in seconds"""
+    name: str
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+    def percentile(self, percent: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def summary(self, elapsed: float = None) -> dict:
+        summary = {
+            'count': len(self.latencies),
+            'errors': self.errors,
+            'mean_ms': statistics.fmean(self.latencies) * 1000 if self.latencies else 0.0,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+        }
+        if elapsed:
+            summary['throughput_rps'] = len(self.latencies) / elapsed
+        return summary
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write_results(path: str, kind: str, params: dict, results: dict):
+    report = {
+        'kind': kind,
+        'revision': _git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'params': params,
+        'results': results,
+    }
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+def compare(baseline_path: str, candidate_path: str, threshold: float) -> int:
+    """Print relative change of every metric, return number of regressions worse than threshold percent"""
+    with open(baseline_path) as baseline_file, open(candidate_path) as candidate_file:
+        baseline, candidate = json.load(baseline_file)['results'], json.load(candidate_file)['results']
+
+    regressions = 0
+    print(f"{'operation':<32}{'metric':<16}{'baseline':>12}{'candidate':>12}{'change':>10}")
+    for name in sorted(baseline.keys() & candidate.keys()):
+        for metric in sorted(baseline[name].keys() & candidate[name].keys()):
+            before, after = baseline[name][metric], candidate[name][metric]
+            if metric in ('count', 'errors') or not before:
+                continue
+            change = (after - before) / before * 100
+            higher_is_better = metric.startswith('throughput') or metric.endswith('_per_sec')
+            regressed = change < -threshold if higher_is_better else change > threshold
+            regressions += regressed
+            print(f"{name:<32}{metric:<16}{before:>12.3f}{after:>12.3f}{change:>+9.1f}%{' !' if regressed else ''}")
+    return regressions
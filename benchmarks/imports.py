@@ -0,0 +1,34 @@
+import re
+import subprocess
+import sys
+
+from benchmarks import APP_SRC
+from benchmarks.harness import Samples
+
+IMPORT_TIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+def _import_times(module: str) -> dict[str, int]:
+    """Cumulative import time in microseconds of every top-level import done by `import module`"""
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               cwd=APP_SRC, capture_output=True, text=True, check=True)
+    times = {}
+    for line in completed.stderr.splitlines():
+        if (match := IMPORT_TIME_RE.match(line)) and len(match.group(3)) == 1:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def run_imports(module: str, repeat: int, top: int) -> dict:
+    """Import `module` in `repeat` fresh interpreters, report its import time and the slowest top-level imports"""
+    samples, slowest = Samples(f'import_{module}'), {}
+    for _ in range(repeat):
+        times = _import_times(module)
+        samples.latencies.append(times[module] / 1_000_000)
+        for name, cumulative in times.items():
+            slowest[name] = max(slowest.get(name, 0), cumulative)
+    ranked = sorted(slowest.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        samples.name: samples.summary(),
+        'slowest_imports_ms': {name: cumulative / 1000 for name, cumulative in ranked},
+    }
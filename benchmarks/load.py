@@ -0,0 +1,98 @@
+import asyncio
+import time
+import uuid
+
+import httpx
+
+from benchmarks.harness import Samples
+
+API_PREFIX = '/api/v1/auth'
+
+
+def use_fake_redis():
+    """Point the app's Redis pool at an in-process fakeredis server"""
+    import fakeredis
+    from fakeredis.aioredis import FakeConnection
+    from redis.asyncio import ConnectionPool
+
+    from db import redis_inj
+
+    redis_inj.redis_pool = ConnectionPool(connection_class=FakeConnection, server=fakeredis.FakeServer())
+
+
+async def _timed(samples: Samples, request) -> httpx.Response | None:
+    started = time.perf_counter()
+    try:
+        response = await request
+    except httpx.HTTPError:
+        samples.errors += 1
+        return None
+    if response.is_success:
+        samples.latencies.append(time.perf_counter() - started)
+        return response
+    samples.errors += 1
+    return None
+
+
+async def _user_session(client: httpx.AsyncClient, samples: dict[str, Samples], run_id: str, number: int,
+                        rerolls: int):
+    username, password = f'bench_{run_id}_{number}', f'password-{number}'
+    email, headers = f'{username}@bench.local', {'User-Agent': f'benchmark/{number}'}
+
+    signup = client.post(f'{API_PREFIX}/signup', headers=headers, json={
+        'username': username, 'email': email, 'password_hash': password, 'first_name': None, 'last_name': None,
+    })
+    if not await _timed(samples['signup'], signup):
+        return
+    login = client.post(f'{API_PREFIX}/login', headers=headers, data={'email': email, 'password': password})
+    if not (response := await _timed(samples['login'], login)):
+        return
+    access, refresh = response.json()
+    for _ in range(rerolls):
+        reroll = client.post(f'{API_PREFIX}/reroll', headers=headers, json={'refresh_token': refresh})
+        if not (response := await _timed(samples['reroll'], reroll)):
+            return
+        access, refresh = response.json()
+    logout = client.post(f'{API_PREFIX}/logout', headers={**headers, 'Authorization': f'Bearer {access}'})
+    await _timed(samples['logout'], logout)
+
+
+async def run_load(users: int, concurrency: int, rerolls: int, url: str = None, fake_redis: bool = False) -> dict:
+    """Run signup -> login -> reroll x N -> logout for every user, at most `concurrency` users at once"""
+    samples = {name: Samples(name) for name in ('signup', 'login', 'reroll', 'logout')}
+    run_id = uuid.uuid4().hex[:8]
+    semaphore = asyncio.Semaphore(concurrency)
+    app = None
+
+    if url:
+        client = httpx.AsyncClient(base_url=url, timeout=60)
+    else:
+        if fake_redis:
+            use_fake_redis()
+        from core.config import SETTINGS
+        # every benchmark user logs in from the same address, the per-IP bucket would reject most of them
+        SETTINGS.RATE_LIMIT.LOGIN_RATE_LIMIT_ENABLED = False
+        from main import app
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://benchmark', timeout=60)
+
+    async def limited(number: int):
+        async with semaphore:
+            await _user_session(client, samples, run_id, number, rerolls)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(limited(number) for number in range(users)))
+    finally:
+        elapsed = time.perf_counter() - started
+        await client.aclose()
+        if app is not None:
+            await lifespan.__aexit__(None, None, None)
+
+    results = {name: sample.summary(elapsed) for name, sample in samples.items()}
+    total = Samples('total', [latency for sample in samples.values() for latency in sample.latencies],
+                    sum(sample.errors for sample in samples.values()))
+    results['total'] = total.summary(elapsed)
+    results['total']['elapsed_s'] = elapsed
+    return results
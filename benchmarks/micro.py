@@ -0,0 +1,114 @@
+import time
+import uuid
+from typing import Callable, Awaitable
+
+from benchmarks.harness import Samples
+
+
+def bench(name: str, fn: Callable, iterations: int, setup: Callable = None) -> Samples:
+    """Time every call of fn separately, setup runs before each call and is not timed"""
+    samples = Samples(name)
+    for _ in range(iterations):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        samples.latencies.append(time.perf_counter() - started)
+    return samples
+
+
+async def abench(name: str, fn: Callable[[], Awaitable], iterations: int) -> Samples:
+    samples = Samples(name)
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await fn()
+        samples.latencies.append(time.perf_counter() - started)
+    return samples
+
+
+def _summaries(samples: list[Samples]) -> dict:
+    results = {}
+    for sample in samples:
+        summary = sample.summary()
+        summary['ops_per_sec'] = 1000 / summary['mean_ms'] if summary['mean_ms'] else 0.0
+        results[sample.name] = summary
+    return results
+
+
+def jwt_benchmarks(iterations: int) -> list[Samples]:
+    from services.jwt import create_access_token, JWTBearer, claims_cache
+
+    subject = uuid.uuid4()
+    token = create_access_token(subject=subject, useragent='benchmark')
+    return [
+        bench('create_access_token', lambda: create_access_token(subject=subject, useragent='benchmark'), iterations),
+        bench('verify_jwt', lambda: JWTBearer.verify_jwt(token), iterations, setup=claims_cache.clear),
+        bench('verify_jwt_cached', lambda: JWTBearer.verify_jwt(token), iterations),
+    ] + codec_benchmarks(token, iterations)
+
+
+def codec_benchmarks(token: str, iterations: int) -> list[Samples]:
+    """Codec against python-jose on the same claims and key, the codec is checked to match jose byte for byte"""
+    from jose import jwt
+    from services.jwt_codec import jwt_codec
+    from services.keyring import keyring
+
+    claims = jwt_codec.decode(token)
+    if keyring.symmetric and jwt.encode(claims, keyring.signing_key, keyring.algorithm) != jwt_codec.encode(claims):
+        raise AssertionError('jwt_codec output differs from python-jose')
+    verification_key = keyring.verification_key(keyring.signing_kid)
+    return [
+        bench('codec_encode', lambda: jwt_codec.encode(claims), iterations),
+        bench('jose_encode', lambda: jwt.encode(claims, keyring.signing_key, keyring.algorithm,
+                                                headers=keyring.headers), iterations),
+        bench('codec_decode', lambda: jwt_codec.decode(token), iterations),
+        bench('jose_decode', lambda: jwt.decode(token, verification_key, algorithms=keyring.algorithm), iterations),
+    ]
+
+
+async def password_benchmarks(iterations: int) -> list[Samples]:
+    from services.password import get_hashed_password, verify_password, verify_password_async, \
+        shutdown_password_executor
+
+    hashed = get_hashed_password('benchmark')
+    samples = [bench('verify_password', lambda: verify_password('benchmark', hashed), iterations)]
+    await verify_password_async('benchmark', hashed)
+    samples.append(await abench('verify_password_async', lambda: verify_password_async('benchmark', hashed),
+                                iterations))
+    shutdown_password_executor()
+    return samples
+
+
+async def crud_benchmarks(iterations: int) -> list[Samples]:
+    from db.database import async_session
+    from models.schemas.auth import UserCreate
+    from services.crud.users import create_user, get_user_by_email, get_user_by_id, delete_user
+    from services.crud.refresh_tokens import upsert_token
+    from services.password import get_hashed_password
+
+    run_id = uuid.uuid4().hex[:8]
+    email = f'micro_{run_id}@bench.local'
+    async with async_session() as db:
+        user = await create_user(db=db, user=UserCreate(
+            username=f'micro_{run_id}', email=email, password_hash=get_hashed_password('benchmark'),
+            first_name=None, last_name=None,
+        ))
+        try:
+            samples = [
+                await abench('get_user_by_email', lambda: get_user_by_email(db=db, email=email), iterations),
+                await abench('get_user_by_id', lambda: get_user_by_id(db=db, user_id=user.id), iterations),
+                await abench('upsert_token', lambda: upsert_token(db=db, jti=uuid.uuid4(),
+                                                                  useragent='benchmark', user_id=user.id),
+                             iterations),
+            ]
+        finally:
+            await delete_user(db=db, user_id=user.id)
+    return samples
+
+
+async def run_micro(iterations: int, password_iterations: int, with_db: bool) -> dict:
+    samples = jwt_benchmarks(iterations)
+    samples += await password_benchmarks(password_iterations)
+    if with_db:
+        samples += await crud_benchmarks(iterations)
+    return _summaries(samples)
@@ -0,0 +1,95 @@
+"""
+Tests import the service from app/src like the app itself does.
+Redis tests start their own redis-server processes and are skipped without the binary.
+Postgres tests use POSTGRES_* of the environment (a throwaway database) and are skipped when it is not reachable.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'src')
+sys.path.insert(0, SRC_DIR)
+
+for name, value in {
+    'POSTGRES_HOST': 'localhost', 'POSTGRES_PORT': '5432', 'POSTGRES_DB': 'test', 'POSTGRES_USER': 'app',
+    'POSTGRES_PASSWORD': '123qwe', 'REDIS_HOST': 'localhost', 'REDIS_PORT': '6379',
+    'PROJECT_NAME': 'test', 'PROJECT_DOMAIN': 'localhost', 'PROJECT_PORT': '80', 'DEBUG': 'False',
+    'ACCESS_TOKEN_EXPIRE_MINUTES': '30', 'REFRESH_TOKEN_EXPIRE_MINUTES': '10080', 'ALGORITHM': 'HS256',
+    'SECRET_KEY': 'test-secret', 'REFRESH_SECRET_KEY': 'test-refresh-secret', 'PASSWORD_BCRYPT_ROUNDS': '4',
+}.items():
+    os.environ.setdefault(name, value)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'redis-server on port {port} did not start')
+
+
+@pytest.fixture
+def redis_servers():
+    """Factory starting n empty redis-server processes, returns their redis:// URLs"""
+    if not shutil.which('redis-server'):
+        pytest.skip('redis-server is not installed')
+    processes = []
+    workdir = tempfile.mkdtemp()
+
+    def start(n: int) -> list[str]:
+        urls = []
+        for _ in range(n):
+            port = _free_port()
+            processes.append(subprocess.Popen(
+                ['redis-server', '--port', str(port), '--bind', '127.0.0.1', '--save', '', '--appendonly', 'no',
+                 '--dir', workdir],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            ))
+            _wait_for_port(port)
+            urls.append(f'redis://127.0.0.1:{port}/0')
+        return urls
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+@pytest.fixture
+def postgres():
+    """Fresh schema in the POSTGRES_* database, dropped after the test"""
+    try:
+        socket.create_connection((os.environ['POSTGRES_HOST'], int(os.environ['POSTGRES_PORT'])), timeout=0.5).close()
+    except OSError:
+        pytest.skip('Postgres is not reachable')
+    from sqlalchemy import create_engine, text
+
+    from core.config import SETTINGS
+    from db.database import Base
+    import models.models  # noqa: F401, registers tables
+
+    engine = create_engine(SETTINGS.SQLALCHEMY_DATABASE_URL_SYNC)
+    with engine.begin() as connection:
+        connection.execute(text('DROP SCHEMA IF EXISTS content CASCADE'))
+        connection.execute(text('CREATE SCHEMA content'))
+        Base.metadata.create_all(connection)
+    yield
+    with engine.begin() as connection:
+        connection.execute(text('DROP SCHEMA content CASCADE'))
+    engine.dispose()
@@ -0,0 +1,52 @@
+import asyncio
+import time
+import uuid
+
+import pytest
+
+pytest.importorskip('redis')
+from core.config import SETTINGS  # noqa: E402
+from db.redis_inj import InstrumentedConnectionPool, InstrumentedRedis  # noqa: E402
+from services.blacklist import RevokedTokensCache  # noqa: E402
+from services.blacklist_store import blacklist_store  # noqa: E402
+
+# nothing listens on port 1, connecting is refused at once
+DOWN_URL = 'redis://127.0.0.1:1/0'
+
+
+def test_unreachable_node_does_not_hold_up_pub_sub(redis_servers, monkeypatch):
+    main_url, node_url = redis_servers(2)
+    jti = str(uuid.uuid4())
+
+    async def scenario():
+        pool = InstrumentedConnectionPool.from_url(main_url)
+        main = InstrumentedRedis(connection_pool=pool)
+        cache = RevokedTokensCache()
+        try:
+            monkeypatch.setattr(SETTINGS.REDIS, 'REDIS_BLACKLIST_NODES', [node_url, DOWN_URL])
+            blacklist_store.configure(main=main)
+            await asyncio.wait_for(cache.on_connect(main), timeout=1)
+            await asyncio.sleep(0.2)
+            assert not cache.ready
+            cache.on_message(f'{jti} {int(time.time()) + 600}')
+            assert cache.might_be_revoked(jti)
+            cache.on_disconnect()
+            await blacklist_store.close()
+
+            monkeypatch.setattr(SETTINGS.REDIS, 'REDIS_BLACKLIST_NODES', [node_url])
+            blacklist_store.configure(main=main)
+            await blacklist_store.add_many([(jti, int(time.time()) + 600)])
+            await cache.on_connect(main)
+            for _ in range(50):
+                if cache.ready:
+                    break
+                await asyncio.sleep(0.1)
+            assert cache.ready
+            assert cache.might_be_revoked(jti)
+            assert not cache.might_be_revoked(str(uuid.uuid4()))
+        finally:
+            cache.on_disconnect()
+            await blacklist_store.close()
+            await pool.disconnect()
+
+    asyncio.run(scenario())
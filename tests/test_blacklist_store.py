@@ -0,0 +1,130 @@
+import asyncio
+import time
+import uuid
+from collections import Counter
+
+import pytest
+
+pytest.importorskip('redis')
+from core.config import SETTINGS  # noqa: E402
+from db.redis_inj import InstrumentedConnectionPool, InstrumentedRedis  # noqa: E402
+from services.blacklist_store import BlacklistStore, HashRing  # noqa: E402
+
+JTIS = [str(uuid.uuid4()) for _ in range(300)]
+
+
+def test_ring_spreads_keys_and_moves_few_on_new_node():
+    ring = HashRing(['a', 'b', 'c'], vnodes=160)
+    placement = Counter(map(ring.node_for, JTIS * 10))
+    assert set(placement) == {'a', 'b', 'c'}
+    assert min(placement.values()) > len(JTIS) * 10 / 3 * 0.7
+
+    grown = HashRing(['a', 'b', 'c', 'd'], vnodes=160)
+    moved = [jti for jti in JTIS if ring.node_for(jti) != grown.node_for(jti)]
+    assert all(grown.node_for(jti) == 'd' for jti in moved)
+    assert len(moved) < len(JTIS) / 2
+
+
+@pytest.fixture
+def nodes(redis_servers, monkeypatch):
+    """Main Redis and three blacklist nodes. `configure(current, previous)` builds a store over some of the nodes,
+    `run` runs a scenario and closes every client it opened in the same event loop"""
+    main_url, *node_urls = redis_servers(4)
+    stores, pools = [], []
+
+    def client(url: str) -> InstrumentedRedis:
+        pools.append(pool := InstrumentedConnectionPool.from_url(url))
+        return InstrumentedRedis(connection_pool=pool)
+
+    def configure(current: list[str], previous: list[str] = ()) -> BlacklistStore:
+        monkeypatch.setattr(SETTINGS.REDIS, 'REDIS_BLACKLIST_NODES', list(current))
+        monkeypatch.setattr(SETTINGS.REDIS, 'REDIS_BLACKLIST_PREVIOUS_NODES', list(previous))
+        store = BlacklistStore()
+        store.configure(main=client(main_url))
+        stores.append(store)
+        return store
+
+    def run(scenario):
+        async def run_and_close():
+            try:
+                await scenario()
+            finally:
+                for store in stores:
+                    await store.close()
+                for pool in pools:
+                    await pool.disconnect()
+        asyncio.run(run_and_close())
+
+    return main_url, node_urls, configure, client, run
+
+
+async def keys_of(redis: InstrumentedRedis) -> set[str]:
+    return {key.decode() for key in await redis.keys('*')}
+
+
+def test_writes_and_reads_go_to_owner_nodes(nodes):
+    main_url, node_urls, configure, client, run = nodes
+
+    async def scenario():
+        store = configure(node_urls)
+        ring = HashRing(node_urls, vnodes=SETTINGS.REDIS.REDIS_BLACKLIST_VNODES)
+        exp = int(time.time()) + 600
+        await store.add_many([(jti, exp) for jti in JTIS[:200]])
+        for url in node_urls:
+            assert await keys_of(client(url)) == {jti for jti in JTIS[:200] if ring.node_for(jti) == url}
+        assert not await keys_of(client(main_url))
+
+        mget_calls = Counter()
+        for url in node_urls:
+            node = store._clients[url]
+            mget = node.mget
+
+            async def counted(keys, *args, _url=url, _mget=mget):
+                mget_calls[_url] += 1
+                return await _mget(keys, *args)
+            node.mget = counted
+        assert await store.get_many(JTIS) == [True] * 200 + [False] * 100
+        assert mget_calls == Counter({url: 1 for url in node_urls})
+
+    run(scenario)
+
+
+def test_previous_ring_is_read_until_rebalance_keeps_ttls(nodes):
+    main_url, node_urls, configure, client, run = nodes
+
+    async def scenario():
+        exp = int(time.time()) + 600
+        await configure(node_urls[:2]).add_many([(jti, exp) for jti in JTIS])
+
+        store = configure(node_urls, previous=node_urls[:2])
+        assert await store.get_many(JTIS) == [True] * len(JTIS)
+
+        assert await store.rebalance() > 0
+        ring = HashRing(node_urls, vnodes=SETTINGS.REDIS.REDIS_BLACKLIST_VNODES)
+        for url in node_urls:
+            redis = client(url)
+            owned = {jti for jti in JTIS if ring.node_for(jti) == url}
+            assert await keys_of(redis) == owned
+            for jti in owned:
+                assert 590 <= await redis.ttl(jti) <= 600
+
+        settled = configure(node_urls, previous=node_urls)
+        assert await settled.get_many(JTIS) == [True] * len(JTIS)
+
+    run(scenario)
+
+
+def test_first_move_off_main_keeps_revocations(nodes):
+    main_url, node_urls, configure, client, run = nodes
+
+    async def scenario():
+        exp = int(time.time()) + 600
+        await configure([]).add_many([(jti, exp) for jti in JTIS])
+
+        store = configure(node_urls)
+        assert await store.get_many(JTIS) == [True] * len(JTIS)
+        assert await store.rebalance() == len(JTIS)
+        assert not await keys_of(client(main_url))
+        assert await store.get_many(JTIS) == [True] * len(JTIS)
+
+    run(scenario)
@@ -0,0 +1,54 @@
+import asyncio
+import ipaddress
+from http import HTTPStatus
+
+import pytest
+
+pytest.importorskip('redis')
+from fastapi import HTTPException  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+
+from core.config import SETTINGS  # noqa: E402
+from db.redis_inj import InstrumentedConnectionPool, InstrumentedRedis  # noqa: E402
+from services import rate_limit  # noqa: E402
+
+PROXY = '172.18.0.5'
+
+
+def forwarded_request(forwarded_for: str, peer: str = PROXY) -> Request:
+    return Request({'type': 'http', 'method': 'POST', 'path': '/api/v1/auth/login', 'query_string': b'',
+                    'client': (peer, 40000), 'headers': [(b'x-forwarded-for', forwarded_for.encode())]})
+
+
+@pytest.fixture
+def trusted_proxy(monkeypatch):
+    monkeypatch.setattr(rate_limit, '_trusted_proxies', [ipaddress.ip_network('172.16.0.0/12')])
+    rate_limit.blocked_clients.clear()
+    yield
+    rate_limit.blocked_clients.clear()
+
+
+def test_client_ip_is_read_from_trusted_proxy_only(trusted_proxy):
+    assert rate_limit.client_ip(forwarded_request('203.0.113.7')) == '203.0.113.7'
+    assert rate_limit.client_ip(forwarded_request('198.51.100.1, 203.0.113.7')) == '203.0.113.7'
+    assert rate_limit.client_ip(forwarded_request('203.0.113.7', peer='198.51.100.9')) == '198.51.100.9'
+
+
+def test_forwarded_clients_get_separate_buckets(trusted_proxy, redis_servers, monkeypatch):
+    redis_url, = redis_servers(1)
+    monkeypatch.setattr(SETTINGS.RATE_LIMIT, 'LOGIN_RATE_IP_LIMIT', 2)
+
+    async def scenario():
+        pool = InstrumentedConnectionPool.from_url(redis_url)
+        redis = InstrumentedRedis(connection_pool=pool)
+        try:
+            for attempt in range(2):
+                await rate_limit.login_rate_limit(forwarded_request('203.0.113.7'), f'a{attempt}@example.com', redis)
+            with pytest.raises(HTTPException) as error:
+                await rate_limit.login_rate_limit(forwarded_request('203.0.113.7'), 'a2@example.com', redis)
+            assert error.value.status_code == HTTPStatus.TOO_MANY_REQUESTS
+            await rate_limit.login_rate_limit(forwarded_request('203.0.113.8'), 'b@example.com', redis)
+        finally:
+            await pool.disconnect()
+
+    asyncio.run(scenario())
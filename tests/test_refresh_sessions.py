@@ -0,0 +1,78 @@
+import asyncio
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+
+import pytest
+
+pytest.importorskip('asyncpg')
+from fastapi import BackgroundTasks, HTTPException  # noqa: E402
+
+from api.v1.auth import login_user, reroll_tokens  # noqa: E402
+from db import redis_inj  # noqa: E402
+from db.database import async_session, dispose_engine  # noqa: E402
+from models.schemas.auth import UserCreate  # noqa: E402
+from services.blacklist_store import blacklist_store  # noqa: E402
+from services.crud.users import create_user  # noqa: E402
+from services.password import get_hashed_password, shutdown_password_executor  # noqa: E402
+
+EMAIL, PASSWORD, USER_AGENT = 'alice@example.com', 'secret', 'Mozilla/5.0 (X11; Linux x86_64)'
+
+
+@asynccontextmanager
+async def service(redis_url: str):
+    redis_inj.redis_pool = redis_inj.InstrumentedConnectionPool.from_url(redis_url)
+    blacklist_store.configure(main=await redis_inj.get_redis())
+    try:
+        async with async_session() as db:
+            await create_user(db, UserCreate(username='alice', email=EMAIL,
+                                             password_hash=get_hashed_password(PASSWORD)))
+        yield
+    finally:
+        await blacklist_store.close()
+        await redis_inj.redis_pool.disconnect()
+        redis_inj.redis_pool = None
+        await dispose_engine()
+        shutdown_password_executor()
+
+
+async def login() -> tuple[str, str]:
+    async with async_session() as db:
+        return await login_user(email=EMAIL, password=PASSWORD, background_tasks=BackgroundTasks(), db=db,
+                                redis=await redis_inj.get_redis(), user_agent=USER_AGENT)
+
+
+async def reroll(refresh_token: str) -> tuple[str, str]:
+    async with async_session() as db:
+        return await reroll_tokens(refresh_token=refresh_token, redis=await redis_inj.get_redis(), db=db,
+                                   user_agent=USER_AGENT)
+
+
+def test_second_login_revokes_first_refresh_token(postgres, redis_servers):
+    redis_url, = redis_servers(1)
+
+    async def scenario():
+        async with service(redis_url):
+            _, first_refresh = await login()
+            _, second_refresh = await login()
+            with pytest.raises(HTTPException) as error:
+                await reroll(first_refresh)
+            assert error.value.status_code == HTTPStatus.FORBIDDEN
+            assert await reroll(second_refresh)
+
+    asyncio.run(scenario())
+
+
+def test_reused_refresh_token_revokes_session(postgres, redis_servers):
+    redis_url, = redis_servers(1)
+
+    async def scenario():
+        async with service(redis_url):
+            _, first_refresh = await login()
+            _, rotated_refresh = await reroll(first_refresh)
+            with pytest.raises(HTTPException) as error:
+                await reroll(first_refresh)
+            assert error.value.status_code == HTTPStatus.FORBIDDEN
+            with pytest.raises(HTTPException):
+                await reroll(rotated_refresh)
+
+    asyncio.run(scenario())
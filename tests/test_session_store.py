@@ -0,0 +1,57 @@
+import asyncio
+import uuid
+
+import pytest
+
+pytest.importorskip('redis')
+from db.redis_inj import InstrumentedConnectionPool, InstrumentedRedis  # noqa: E402
+from services.session_store import RECOVERED_KEY, SessionsNotRecovered, TokenReuseDetected, session_store  # noqa: E402
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64)'
+
+
+def test_missing_session_is_not_reuse_until_recovered(redis_servers):
+    redis_url, = redis_servers(1)
+    user_id = uuid.uuid4()
+
+    async def scenario():
+        pool = InstrumentedConnectionPool.from_url(redis_url)
+        redis = InstrumentedRedis(connection_pool=pool)
+        try:
+            with pytest.raises(SessionsNotRecovered):
+                await session_store.upsert(redis, jti=uuid.uuid4(), useragent=USER_AGENT, user_id=user_id,
+                                           expected_jti=str(uuid.uuid4()))
+            assert await session_store.get(redis, useragent=USER_AGENT, user_id=user_id) is None
+
+            await redis.set(RECOVERED_KEY, 1)
+            with pytest.raises(TokenReuseDetected) as reuse:
+                await session_store.upsert(redis, jti=uuid.uuid4(), useragent=USER_AGENT, user_id=user_id,
+                                           expected_jti=str(uuid.uuid4()))
+            assert reuse.value.current is None
+        finally:
+            await pool.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_rotation_needs_the_current_jti(redis_servers):
+    redis_url, = redis_servers(1)
+    user_id, first, second = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+
+    async def scenario():
+        pool = InstrumentedConnectionPool.from_url(redis_url)
+        redis = InstrumentedRedis(connection_pool=pool)
+        try:
+            assert await session_store.upsert(redis, jti=first, useragent=USER_AGENT, user_id=user_id) is None
+            previous = await session_store.upsert(redis, jti=second, useragent=USER_AGENT, user_id=user_id,
+                                                  expected_jti=str(first))
+            assert previous.jti == first
+            with pytest.raises(TokenReuseDetected) as reuse:
+                await session_store.upsert(redis, jti=uuid.uuid4(), useragent=USER_AGENT, user_id=user_id,
+                                           expected_jti=str(first))
+            assert reuse.value.current.jti == second
+            assert await session_store.get(redis, useragent=USER_AGENT, user_id=user_id) is None
+        finally:
+            await pool.disconnect()
+
+    asyncio.run(scenario())